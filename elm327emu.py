@@ -0,0 +1,531 @@
+#!/usr/bin/python
+#
+# elm327emu -- a pseudo-terminal stand-in for an ELM327 plugged into a
+# Volvo 850 / '98 S70/V70, so milageread can be run, load-tested and timed
+# on a Linux (or other POSIX) box without a car.
+#
+# It answers the AT commands milageread's init() uses, and plays the part of
+# the COMBI (ECU 51) for B903, A0 and ATPC.  Things that make real reads
+# slow or fragile can be switched on:
+#   - per-byte latency (serial link speed) and per-frame latency (ECU P2),
+#   - the 5-baud BUS INIT delay before the first request of a connection,
+#   - "7E B9 23" (temporarily delayed) frames ahead of the F9 03 response,
+#   - "<DATA ERROR" concatenation of all frames on one line,
+#   - a corrupted odometer frame (one data bit flipped, checksum unchanged),
+#   - "BUS INIT: ...ERROR" failures for the first N connection attempts,
+#   - the ignition being switched on some seconds after start (BUS INIT
+#     fails until then, and ATRV shows a different voltage),
+#   - the COMBI dropping the connection after session_timeout seconds of
+#     silence, unless the ATWM wakeup message is sent often enough (ATSW),
+#   - a fixed link baud rate, so that a host at another rate only gets
+#     garbage, and ATBRD switching to a faster rate (Linux only),
+#   - '?' replies to chosen commands, like a KWPD3B0-deficient clone,
+#   - answers to other requests, from the COMBI or from other ECUs reached
+#     by ATIIA / ATSH switching.
+#
+# Or it can replay a milageread --capture file, answering each command with
+# what the captured adapter sent, at the captured pace.
+#
+# Usage:
+#   ./elm327emu.py --miles 172450 --link /tmp/elm0
+#   ./milageread.py /tmp/elm0
+#
+# Or from Python:
+#   emu = Elm327Emulator(bus_init_delay=0.5)
+#   port = emu.start()
+#   ...
+#   emu.stop()
+
+import os
+import sys
+import pty
+import tty
+import time
+import fcntl
+import struct
+import select
+import argparse
+import threading
+
+# Linux ioctl reading struct termios2, which holds the actual baud rate even
+# when it isn't one of the standard Bxxx constants.
+TCGETS2 = 0x802C542A
+
+def close(fd):
+    try:
+        os.close(fd)
+    except (OSError, TypeError):
+        # Already closed, or never opened.
+        pass
+
+def checksum(frame):
+    return sum(frame) & 0xFF
+
+class Elm327Emulator(object):
+    def __init__(self, miles=172450, version='ELM327 v1.5', voltage='12.3V',
+                 byte_delay=0.0, frame_delay=0.0, reset_delay=0.0,
+                 bus_init_delay=3.0, pending_frames=0, pending_delay=None, data_error=False,
+                 corrupt=False,
+                 bus_init_errors=0, ignition_delay=0.0, voltage_off='12.8V',
+                 session_timeout=5.0, baud=None, max_baud=500000,
+                 deficient=(), link=None, replay=None, blocks=None):
+        self.miles = miles
+        self.version = version
+        self.voltage = voltage
+        # Seconds per byte sent to the host, eg 10.0/38400 for a real link.
+        self.byte_delay = byte_delay
+        # Seconds the ECU takes to produce each frame, and to follow up a
+        # "7E B9 23" (temporarily delayed) frame (default: frame_delay).
+        self.frame_delay = frame_delay
+        self.pending_delay = frame_delay if pending_delay is None else pending_delay
+        self.reset_delay = reset_delay
+        self.bus_init_delay = bus_init_delay
+        self.pending_frames = pending_frames
+        self.data_error = data_error
+        self.corrupt = corrupt
+        self.bus_init_errors = bus_init_errors
+        # The ignition is off for this many seconds after start(); meanwhile
+        # every BUS INIT fails and ATRV reports voltage_off.
+        self.ignition_delay = ignition_delay
+        self.voltage_off = voltage_off
+        self.started = None
+        # The COMBI ends a connection after this much silence (KWP P3max).
+        self.session_timeout = session_timeout
+        self.last_traffic = 0.0
+        # Link rate after power-on / ATZ.  None accepts any host rate.
+        self.default_baud = baud
+        self.baud = baud
+        # Fastest rate ATBRD may switch to.
+        self.max_baud = max_baud
+        # Commands (without spaces, eg 'ATIIA51') answered with '?'.
+        self.deficient = set(c.replace(' ', '').upper() for c in deficient)
+        # Other requests answered, {(ecu, request bytes): response data}, eg
+        # {(0x51, b'\xb9\x01'): b'\xf9\x01\x12\x34'}.  BUS INIT only
+        # succeeds with the COMBI (51) and ECUs that have an entry here.
+        self.blocks = dict((key, bytearray(data)) for key, data in (blocks or {}).items())
+        self.link = link
+        # (command, [(seconds after command, data), ...]) exchanges from a
+        # capture, answered in order instead of emulating; see replay_exchanges().
+        self.replay = list(replay) if replay is not None else None
+        self.port = None
+        self.master = None
+        self.slave = None
+        self.thread = None
+        self.running = False
+        # Every command received, for tests and benchmarks to inspect.
+        self.commands = []
+        self.reset()
+
+    def reset(self):
+        # Settings as they are after ATZ / power-on.
+        self.echo = True
+        self.linefeeds = False
+        self.headers = False
+        self.protocol = 0
+        self.header = None
+        self.init_address = 0x33
+        # Time the ELM327 waits for more frames after the last one (ATST),
+        # and adaptive timing (ATAT) which can shorten that wait.
+        self.st = 0x32
+        self.adaptive = 1
+        # Wakeup message set by ATWM, and its period in 20 ms units (ATSW).
+        self.wakeup = False
+        self.sw = 0x92
+        # How long ATBRD waits for the host's CR at the new rate (ATBRT).
+        self.brt = 0x12
+        self.baud = self.default_baud
+        self.connected = False
+        # ECU the connection is with, once connected.
+        self.ecu = None
+
+    def start(self):
+        # Open the pty and serve it from a background thread.  Returns the
+        # path of the slave side, which is what milageread should open.
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        if self.link:
+            if os.path.lexists(self.link): os.unlink(self.link)
+            os.symlink(self.port, self.link)
+        self.started = time.time()
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.link or self.port
+
+    def stop(self):
+        self.running = False
+        # Closing the slave side first ends the serve thread's read with
+        # EIO once the host has closed the port too.  The master is only
+        # closed after the thread has gone, so that a thread still reading
+        # can't steal input from a new emulator that reuses the descriptor.
+        close(self.slave)
+        if self.thread is not None: self.thread.join(1.0)
+        close(self.master)
+        if self.link and os.path.lexists(self.link):
+            os.unlink(self.link)
+
+    def serve(self):
+        pending = b''
+        while self.running:
+            try:
+                data = os.read(self.master, 256)
+            except OSError:
+                return
+            if not self.host_baud_ok():
+                # Framing errors: what the host sent is noise to us, and
+                # what we would say is noise to the host.
+                pending = b''
+                if b'\r' in data: os.write(self.master, b'\xf8\x80\x00\xfe')
+                continue
+            pending = pending + data
+            while b'\r' in pending:
+                line, pending = pending.split(b'\r', 1)
+                self.handle(line.decode('ascii', 'replace').strip())
+
+    def send(self, text):
+        data = text.encode('ascii')
+        # With a fixed link rate, output is paced at that rate.
+        byte_delay = 10.0 / self.baud if self.baud else self.byte_delay
+        if byte_delay <= 0:
+            os.write(self.master, data)
+            return
+        # Pace output like a real serial link, a few bytes at a time.
+        for i in range(0, len(data), 8):
+            time.sleep(byte_delay * len(data[i:i + 8]))
+            os.write(self.master, data[i:i + 8])
+
+    def host_baud(self):
+        try:
+            buf = fcntl.ioctl(self.master, TCGETS2, b'\0' * 44)
+        except (IOError, OSError):
+            return None
+        return struct.unpack('4IB19s2I', buf)[-1]
+
+    def host_baud_ok(self):
+        # A UART tolerates a couple of percent of rate mismatch.
+        if self.baud is None:
+            return True
+        host = self.host_baud()
+        return host is None or abs(host - self.baud) <= 0.03 * self.baud
+
+    def switch_baud(self, divisor):
+        # ATBRD hh: say OK at the old rate, switch to 4 MHz / hh, send the
+        # ATI string and wait ATBRT for a CR from the host at the new rate.
+        # Without one, switch back and give the prompt at the old rate.
+        new_baud = 4000000.0 / divisor if divisor else 0
+        if divisor < 8 or new_baud > self.max_baud:
+            self.send('?' + self.eol() + self.eol() + '>')
+            return
+        self.send('OK' + self.eol())
+        old_baud = self.baud
+        self.baud = new_baud
+        self.send(self.version + '\r')
+        ready, _, _ = select.select([self.master], [], [], self.brt * 0.004096)
+        data = os.read(self.master, 256) if ready else b''
+        if b'\r' in data and self.host_baud_ok():
+            self.send('OK' + self.eol() + self.eol() + '>')
+        else:
+            self.baud = old_baud
+            self.send(self.eol() + '>')
+
+    def ignition_on(self):
+        return time.time() - self.started >= self.ignition_delay
+
+    def kept_alive(self):
+        # The ELM327 itself sends the ATWM message every ATSW x 20 ms while a
+        # connection is up; that is enough if it comes before the COMBI times
+        # out.
+        return self.wakeup and 0 < self.sw * 0.020 < self.session_timeout
+
+    def eol(self):
+        return '\r\n' if self.linefeeds else '\r'
+
+    def handle(self, command):
+        self.commands.append(command)
+        if self.replay is not None:
+            self.replay_command(command)
+            return
+        if self.echo:
+            self.send(command + self.eol())
+        cmd = command.replace(' ', '').upper()
+        if cmd.startswith('ATBRD') and len(cmd) == 7:
+            self.switch_baud(int(cmd[5:], 16))
+            return
+        if command == '':
+            reply = None
+        else:
+            reply = self.reply(command)
+        if reply is not None:
+            self.send(reply.replace('\r', self.eol()) + self.eol())
+        self.send(self.eol() + '>')
+
+    def replay_command(self, command):
+        # Answer with the next captured exchange for this command, skipping
+        # any that don't match (the host may have taken a different path).
+        # The captured reply includes the echo, if there was one.
+        while self.replay:
+            captured, chunks = self.replay.pop(0)
+            if captured != command:
+                continue
+            start = time.time()
+            for seconds, data in chunks:
+                time.sleep(max(0, start + seconds - time.time()))
+                os.write(self.master, data)
+            return
+        self.send('?' + self.eol() + self.eol() + '>')
+
+    def reply(self, command):
+        cmd = command.replace(' ', '').upper()
+        if cmd in self.deficient:
+            return '?'
+        if cmd.startswith('AT'):
+            return self.at_command(cmd[2:])
+        try:
+            request = bytearray.fromhex(cmd)
+        except ValueError:
+            return '?'
+        return self.obd_request(request)
+
+    def at_command(self, cmd):
+        if cmd == 'Z':
+            time.sleep(self.reset_delay)
+            self.reset()
+            return '\r' + self.version
+        if cmd == 'WS':
+            self.reset()
+            return '\r' + self.version
+        if cmd == 'D':
+            self.reset()
+            return 'OK'
+        if cmd == 'I':
+            return self.version
+        if cmd == '@1':
+            return 'OBDII to RS232 Interpreter'
+        if cmd == 'RV':
+            return self.voltage if self.ignition_on() else self.voltage_off
+        if cmd in ('E0', 'E1'):
+            self.echo = cmd == 'E1'
+            return 'OK'
+        if cmd in ('L0', 'L1'):
+            self.linefeeds = cmd == 'L1'
+            return 'OK'
+        if cmd in ('H0', 'H1'):
+            self.headers = cmd == 'H1'
+            return 'OK'
+        if cmd.startswith('SP') and len(cmd) == 3:
+            self.protocol = int(cmd[2], 16)
+            return 'OK'
+        if cmd == 'DP':
+            return 'ISO 9141-2' if self.protocol == 3 else 'AUTO'
+        if cmd == 'DPN':
+            return '{0:X}'.format(self.protocol) if self.protocol else 'A0'
+        if cmd.startswith('SH') and len(cmd) == 8:
+            self.header = bytearray.fromhex(cmd[2:])
+            return 'OK'
+        if cmd.startswith('IIA') and len(cmd) == 5:
+            self.init_address = int(cmd[3:], 16)
+            return 'OK'
+        if cmd.startswith('BRT') and len(cmd) == 5:
+            self.brt = int(cmd[3:], 16)
+            return 'OK'
+        if cmd.startswith('SW') and len(cmd) == 4:
+            self.sw = int(cmd[2:], 16)
+            return 'OK'
+        if cmd.startswith('WM'):
+            self.wakeup = True
+            return 'OK'
+        if cmd.startswith('ST') and len(cmd) == 4:
+            self.st = int(cmd[2:], 16)
+            return 'OK'
+        if cmd == 'PC':
+            self.connected = False
+            return 'OK'
+        if cmd in ('AT0', 'AT1', 'AT2'):
+            self.adaptive = int(cmd[2])
+            return 'OK'
+        if cmd in ('AL', 'KW0', 'KW1') or \
+           cmd.startswith('SR'):
+            return 'OK'
+        return '?'
+
+    def obd_request(self, request):
+        if self.protocol != 3 or self.header is None:
+            return 'NO DATA'
+        lines = []
+        if self.connected and not self.kept_alive() and \
+           time.time() - self.last_traffic > self.session_timeout:
+            self.connected = False
+        if not self.connected:
+            time.sleep(self.bus_init_delay)
+            if self.bus_init_errors > 0:
+                self.bus_init_errors = self.bus_init_errors - 1
+                return 'BUS INIT: ...ERROR'
+            ecus = set([0x51]) | set(ecu for ecu, _ in self.blocks)
+            if self.init_address not in ecus or not self.ignition_on():
+                return 'BUS INIT: ...ERROR'
+            self.connected = True
+            self.ecu = self.init_address
+            lines.append('BUS INIT: ...OK')
+        self.last_traffic = time.time()
+        if self.header[1] != self.ecu:
+            lines.append('NO DATA')
+            return '\r'.join(lines)
+        frames = []
+        if (self.ecu, bytes(request)) in self.blocks:
+            frames.append(bytearray(self.blocks[(self.ecu, bytes(request))]))
+        elif self.ecu == 0x51 and bytes(request) == b'\xb9\x03':
+            for _ in range(self.pending_frames):
+                frames.append(bytearray([0x7E, 0xB9, 0x23]))
+            value = self.miles // 10
+            frames.append(bytearray([0xF9, 0x03, value & 0xFF, (value >> 8) & 0xFF]))
+        elif bytes(request) == b'\xa0':
+            # Stop Communication; the COMBI doesn't answer, it just hangs up.
+            self.connected = False
+        else:
+            # serviceNotSupported
+            frames.append(bytearray([0x7E, request[0], 0x11]))
+        if not frames:
+            lines.append('NO DATA')
+            return '\r'.join(lines)
+        # How long the ELM327 waits for another frame.  Adaptive timing is
+        # modelled crudely: it learns the COMBI's normal response time and
+        # waits a margin on top of that, less margin with ATAT2.
+        wait = self.st * 0.004096
+        if self.adaptive:
+            wait = min(wait, self.frame_delay * 1.5 + (0.030 if self.adaptive == 1 else 0.010))
+        # Lines go out as soon as the COMBI has produced each frame, like
+        # on a real adapter; only the prompt waits for the ELM327 to give up.
+        for line in lines:
+            self.send(line + self.eol())
+        texts = []
+        delay = self.frame_delay
+        for data in frames:
+            if texts and delay > wait:
+                # Gave up before the COMBI's next frame came.
+                break
+            time.sleep(delay)
+            delay = self.pending_delay if data[0] == 0x7E and data[-1] == 0x23 else self.frame_delay
+            frame = bytearray([0x80 | (len(data) + 1), 0x13, self.ecu]) + data
+            frame.append(checksum(frame))
+            if self.corrupt and data[0] == 0xF9:
+                frame[-2] ^= 0x04
+            if not self.headers:
+                frame = frame[3:-1]
+            texts.append(' '.join('{0:02X}'.format(b) for b in frame))
+            if not self.data_error:
+                self.send(texts[-1] + self.eol())
+        if self.data_error:
+            # All frames end up on one line, sent once the ELM327 gives up.
+            time.sleep(wait)
+            return ' '.join(texts) + ' <DATA ERROR'
+        time.sleep(wait)
+        return None
+
+def replay_exchanges(records):
+    # Turn milageread.read_capture() records into (command, reply chunks)
+    # exchanges, with each chunk timed relative to its command.
+    exchanges = []
+    pending = b''
+    for seconds, direction, data in records:
+        if direction == 'tx':
+            pending = pending + data
+            while b'\r' in pending:
+                line, pending = pending.split(b'\r', 1)
+                exchanges.append((line.decode('ascii', 'replace').strip(), seconds, []))
+        elif exchanges:
+            command, sent, chunks = exchanges[-1]
+            chunks.append((seconds - sent, data))
+    return [(command, chunks) for command, _, chunks in exchanges]
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate an ELM327 connected to a Volvo COMBI (ECU 51) on a pseudo-terminal.")
+    parser.add_argument('--miles', type=int, default=172450,
+                      help="Odometer reading the COMBI reports (rounded down to 10 miles).")
+    parser.add_argument('--version', default='ELM327 v1.5',
+                      help="ATZ / ATI identification string.")
+    parser.add_argument('--voltage', default='12.3V',
+                      help="ATRV reply.")
+    parser.add_argument('--baud', type=int, default=0,
+                      help="Pace output as if sent at this baud rate (default: as fast as possible).")
+    parser.add_argument('--frame-delay', type=float, default=0.0,
+                      help="Seconds the COMBI takes per frame.")
+    parser.add_argument('--reset-delay', type=float, default=0.0,
+                      help="Seconds ATZ takes.")
+    parser.add_argument('--bus-init-delay', type=float, default=3.0,
+                      help="Seconds the 5-baud BUS INIT takes.")
+    parser.add_argument('--pending-frames', type=int, default=0,
+                      help="Number of \"7E B9 23\" frames before the F9 03 response.")
+    parser.add_argument('--pending-delay', type=float,
+                      help="Seconds the COMBI takes after a \"7E B9 23\" frame (default: --frame-delay).")
+    parser.add_argument('--data-error', action='store_true',
+                      help="Concatenate all frames on one line followed by <DATA ERROR.")
+    parser.add_argument('--corrupt', action='store_true',
+                      help="Flip a bit in the odometer frame's data, leaving the checksum wrong.")
+    parser.add_argument('--bus-init-errors', type=int, default=0,
+                      help="Answer the first N connection attempts with BUS INIT: ...ERROR.")
+    parser.add_argument('--ignition-delay', type=float, default=0.0,
+                      help="Ignition is switched on this many seconds after start; BUS INIT fails until then.")
+    parser.add_argument('--voltage-off', default='12.8V',
+                      help="ATRV reply while the ignition is off.")
+    parser.add_argument('--session-timeout', type=float, default=5.0,
+                      help="Seconds of silence after which the COMBI drops the connection unless kept alive (default 5).")
+    parser.add_argument('--link-baud', type=int,
+                      help="Only understand a host at this baud rate, and pace output at it (default: any rate). ATBRD can raise it.")
+    parser.add_argument('--max-baud', type=int, default=500000,
+                      help="Fastest rate ATBRD accepts (default 500000).")
+    parser.add_argument('--deficient', action='append', default=[],
+                      help="Answer this command with '?' (may be repeated), eg --deficient 'ATIIA 51'.")
+    parser.add_argument('--link',
+                      help="Create a symlink with this name pointing to the pty.")
+    parser.add_argument('--block', action='append', default=[],
+                      help="Also answer this request, eg --block 51:B901=F9011234 or --block 41:B9F0=F9F00102 "
+                           "(may be repeated; other ECUs than the COMBI only connect if they have a block).",
+                      metavar='ECU:REQUEST=RESPONSE')
+    parser.add_argument('--replay',
+                      help="Replay this milageread --capture file instead of emulating.",
+                      metavar='FILE')
+    args = parser.parse_args()
+
+    blocks = {}
+    for spec in args.block:
+        try:
+            key, _, response = spec.partition('=')
+            ecu, _, request = key.partition(':')
+            blocks[(int(ecu, 16), bytes(bytearray.fromhex(request)))] = bytearray.fromhex(response)
+        except ValueError:
+            parser.error("--block wants ECU:REQUEST=RESPONSE in hex, not " + spec)
+
+    replay = None
+    if args.replay:
+        from milageread import read_capture
+        replay = replay_exchanges(read_capture(args.replay))
+
+    emu = Elm327Emulator(miles=args.miles, version=args.version,
+                         voltage=args.voltage,
+                         byte_delay=10.0 / args.baud if args.baud else 0.0,
+                         frame_delay=args.frame_delay,
+                         reset_delay=args.reset_delay,
+                         bus_init_delay=args.bus_init_delay,
+                         pending_frames=args.pending_frames,
+                         pending_delay=args.pending_delay,
+                         data_error=args.data_error,
+                         corrupt=args.corrupt,
+                         bus_init_errors=args.bus_init_errors,
+                         ignition_delay=args.ignition_delay,
+                         voltage_off=args.voltage_off,
+                         session_timeout=args.session_timeout,
+                         baud=args.link_baud, max_baud=args.max_baud,
+                         deficient=args.deficient, link=args.link, replay=replay, blocks=blocks)
+    print("ELM327 emulator listening on {0}".format(emu.start()))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emu.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#
+# milagebench -- time milageread's init() / milageread() flow, per command
+# and end to end, against elm327emu (default) or a real adapter (--port).
+#
+# Reports p50/p95/max latency for every AT and KWP command, for the init and
+# read phases and for the whole time-to-mileage, plus fleet throughput in
+# reads per hour when several adapters are emulated.  Output is JSON, so a
+# release can be compared with a saved result using --baseline.
+#
+# Usage:
+#   ./milagebench.py --runs 5 --output bench.json
+#   ./milagebench.py --fleet 10 --runs 3
+#   ./milagebench.py --baseline bench.json      # exit 1 on regressions
+#   ./milagebench.py --port /dev/ttyUSB0 --runs 3
+
+import sys
+import json
+import time
+import argparse
+import threading
+
+import milageread
+
+def percentile(values, pct):
+    # Nearest-rank percentile; good enough for the handful of samples a
+    # benchmark run produces.
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+def summarize(values):
+    return {'count': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'max': max(values) if values else None}
+
+class Recorder(object):
+    # Collects latency samples from any number of sessions/threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.phases = {}
+        self.reads = 0
+        self.failures = []
+
+    def add(self, table, key, seconds):
+        with self.lock:
+            table.setdefault(key, []).append(seconds)
+
+    def watch(self, session):
+        # Time every elmcommand() the session makes.  The prompt still due
+        # from the previous command (see read_until_prompt()) is collected
+        # first, so that its wait isn't charged to this command.
+        elmcommand = session.elmcommand
+        def timed(command, *args):
+            session.drain_prompt()
+            start = time.time()
+            try:
+                return elmcommand(command, *args)
+            finally:
+                self.add(self.commands, command, time.time() - start)
+        session.elmcommand = timed
+
+def read_once(port, baud, recorder):
+    session = milageread.ElmSession(port, baud, echo=False)
+    recorder.watch(session)
+    start = time.time()
+    result = None
+    try:
+        if session.open():
+            try:
+                t = time.time()
+                ok = session.init()
+                recorder.add(recorder.phases, 'init', time.time() - t)
+                if ok:
+                    t = time.time()
+                    result = session.milageread()
+                    recorder.add(recorder.phases, 'milageread', time.time() - t)
+            finally:
+                session.close()
+    except milageread.ElmError:
+        pass
+    if result:
+        recorder.add(recorder.phases, 'time_to_mileage', time.time() - start)
+        with recorder.lock:
+            recorder.reads = recorder.reads + 1
+    else:
+        with recorder.lock:
+            recorder.failures.append({'port': port,
+                                      'reason': session.messages[-1] if session.messages else ''})
+    return result
+
+def run(args):
+    emulators = []
+    if args.port:
+        ports = [args.port]
+    else:
+        import elm327emu
+        ports = []
+        for _ in range(args.fleet):
+            emu = elm327emu.Elm327Emulator(byte_delay=10.0 / int(args.baud),
+                                           frame_delay=args.frame_delay,
+                                           reset_delay=args.reset_delay,
+                                           bus_init_delay=args.bus_init_delay,
+                                           pending_frames=args.pending_frames)
+            ports.append(emu.start())
+            emulators.append(emu)
+
+    recorder = Recorder()
+
+    def adapter(index, port):
+        for _ in range(args.runs):
+            if emulators:
+                # BUS INIT failures are injected afresh for every read.
+                emulators[index].bus_init_errors = args.bus_init_errors
+            read_once(port, args.baud, recorder)
+
+    start = time.time()
+    threads = [threading.Thread(target=adapter, args=(i, port)) for i, port in enumerate(ports)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.time() - start
+    for emu in emulators: emu.stop()
+
+    return {'config': {'adapters': len(ports),
+                       'runs': args.runs,
+                       'baud': int(args.baud),
+                       'emulated': not args.port,
+                       'frame_delay': args.frame_delay,
+                       'reset_delay': args.reset_delay,
+                       'bus_init_delay': args.bus_init_delay,
+                       'pending_frames': args.pending_frames,
+                       'bus_init_errors': args.bus_init_errors},
+            'commands': dict((cmd, summarize(v)) for cmd, v in recorder.commands.items()),
+            'phases': dict((name, summarize(v)) for name, v in recorder.phases.items()),
+            'throughput': {'reads': recorder.reads,
+                           'seconds': elapsed,
+                           'reads_per_hour': recorder.reads * 3600.0 / elapsed if elapsed else None},
+            'failures': recorder.failures}
+
+def regressions(result, baseline, tolerance, min_delta):
+    # Compare p50/p95 of every phase and command present in both results.
+    # Slowdowns below min_delta seconds are scheduling noise, not regressions.
+    found = []
+    for section in ('phases', 'commands'):
+        for name, old in baseline.get(section, {}).items():
+            new = result[section].get(name)
+            if not new:
+                continue
+            for stat in ('p50', 'p95'):
+                if old.get(stat) and new.get(stat) and new[stat] > old[stat] * (1 + tolerance) \
+                   and new[stat] - old[stat] > min_delta:
+                    found.append("{0} {1} {2}: {3:.3f}s -> {4:.3f}s".format(section, name, stat, old[stat], new[stat]))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark milageread against elm327emu or a real ELM327.")
+    parser.add_argument('--port',
+                      help="Benchmark this real adapter instead of emulated ones.")
+    parser.add_argument('-b', '--baud', default='38400', choices=['38400', '115200'],
+                      help="Baud rate (emulated link is paced at this rate).")
+    parser.add_argument('--runs', type=int, default=3,
+                      help="Reads per adapter (default 3).")
+    parser.add_argument('--fleet', type=int, default=1,
+                      help="Number of emulated adapters read concurrently (default 1).")
+    parser.add_argument('--frame-delay', type=float, default=0.05,
+                      help="Emulated COMBI seconds per frame (default 0.05).")
+    parser.add_argument('--reset-delay', type=float, default=1.0,
+                      help="Emulated ATZ seconds (default 1.0).")
+    parser.add_argument('--bus-init-delay', type=float, default=3.0,
+                      help="Emulated BUS INIT seconds (default 3.0).")
+    parser.add_argument('--pending-frames', type=int, default=0,
+                      help="Emulated \"7E B9 23\" frames per B903.")
+    parser.add_argument('--bus-init-errors', type=int, default=0,
+                      help="Emulated BUS INIT: ...ERROR count before each read succeeds.")
+    parser.add_argument('--output',
+                      help="Write the JSON result here instead of stdout.")
+    parser.add_argument('--baseline',
+                      help="Earlier JSON result; exit 1 if any p50/p95 got slower by more than --tolerance.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                      help="Allowed slowdown against --baseline as a fraction (default 0.2).")
+    parser.add_argument('--min-delta', type=float, default=0.01,
+                      help="Ignore slowdowns smaller than this many seconds (default 0.01).")
+    args = parser.parse_args()
+
+    result = run(args)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(result, json.load(f), args.tolerance, args.min_delta)
+        for line in found:
+            sys.stderr.write("Regression: " + line + '\n')
+        if found:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+#
+# milagelogs -- find every B903 (read Vehicle Mileage from the COMBI)
+# exchange in old OBDwiz / TouchScan or milageread logs and write one
+# mileage record per exchange as CSV or JSON lines.
+#
+# Understood log formats (mixed freely, even in one file):
+#   - OBDwiz / TouchScan Raw Data Log      B903: [85 13 51 F9 03 5D 43 85]
+#   - OBDwiz / TouchScan Console Log       B903:
+#                                          85 13 51 F9 03 5D 43 85
+#   - milageread --debug output            B903: BUS INIT: ...OK
+#                                          85 13 51 F9 03 5D 43 85
+# A response may run over several lines ("BUS INIT: ...OK", "7E B9 23"
+# temporarily delayed responses, <DATA ERROR concatenations) and ends at the
+# next request.  The frames are checked by milageread's KwpDecoder, so only a
+# complete F9 03 frame with a correct checksum gives a reading; responses
+# logged without headers (ATH0) can not be checked and are reported as
+# having no response.
+#
+# Files are read a line at a time, and big files are split into chunks at
+# line boundaries, so memory use does not depend on the size of the logs.
+# Files and chunks are scanned by a pool of worker processes; records are
+# written in file order.
+#
+# Usage:
+#   ./milagelogs.py logs/ > milage.csv
+#   ./milagelogs.py --format json --output milage.jsonl 'logs/2016*.txt'
+#   ./milagelogs.py --errors --jobs 8 /mnt/workshop/logs
+
+import os
+import re
+import sys
+import csv
+import glob
+import json
+import argparse
+import multiprocessing
+
+from milageread import KwpDecoder, decode_milage
+
+# A request is an AT command or hex bytes followed by ':'.  Response lines
+# never look like that ("BUS INIT: ...OK" is not hex).
+REQUEST = re.compile(r'^\s*(AT[^:]*?|[0-9A-Fa-f]{2}(?: ?[0-9A-Fa-f]{2})*)\s*:(.*)$')
+
+FIELDS = ['file', 'offset', 'miles', 'kilometers', 'error', 'response']
+
+class Exchange(object):
+    # One B903 request and the lines of its response.
+    def __init__(self, path, offset):
+        self.path = path
+        self.offset = offset
+        self.decoder = KwpDecoder(0xF9, 0x03)
+        self.lines = []
+
+    def feed(self, text):
+        if self.decoder.done:
+            # Anything after the F9 03 frame isn't part of the response.
+            return
+        text = text.replace('[', ' ').replace(']', ' ').strip()
+        if not text:
+            return
+        self.lines.append(text)
+        self.decoder.feed(text + '\r')
+
+    def record(self):
+        miles = kilometers = None
+        error = ''
+        decoder = self.decoder
+        if decoder.payload is not None and len(decoder.payload) >= 2:
+            miles, kilometers = decode_milage(decoder.payload)
+        elif decoder.rejected:
+            error = 'checksum mismatch'
+        elif decoder.pending:
+            error = 'temporarily delayed'
+        else:
+            errors = [line for line in self.lines
+                      if ('ERROR' in line and 'DATA ERROR' not in line)
+                      or 'NO DATA' in line or 'STOPPED' in line]
+            error = errors[-1] if errors else 'no response'
+        return {'file': self.path,
+                'offset': self.offset,
+                'miles': miles,
+                'kilometers': kilometers,
+                'error': error,
+                'response': ' | '.join(self.lines)}
+
+def scan(task):
+    # Records of the B903 requests starting in bytes [start, end) of path.
+    # The last exchange may read past end; lines before the first request
+    # belong to the previous chunk's last exchange.
+    path, start, end = task
+    records = []
+    exchange = None
+    with open(path, 'rb') as f:
+        if start:
+            # Skip to the first line starting at or after start.
+            f.seek(start - 1)
+            f.readline()
+        offset = f.tell()
+        for raw in iter(f.readline, b''):
+            line = raw.decode('latin-1')
+            match = REQUEST.match(line)
+            if match:
+                if exchange is not None:
+                    records.append(exchange.record())
+                    exchange = None
+                if offset >= end:
+                    break
+                if match.group(1).replace(' ', '').upper() == 'B903':
+                    exchange = Exchange(path, offset)
+                    exchange.feed(match.group(2))
+            elif exchange is not None:
+                exchange.feed(line)
+            offset = offset + len(raw)
+    if exchange is not None:
+        records.append(exchange.record())
+    return records
+
+def expand_paths(patterns):
+    # Files named, matched by a glob, or anywhere below a named directory.
+    paths = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    paths.extend(os.path.join(root, name) for name in sorted(files))
+            else:
+                paths.append(path)
+    return paths
+
+def tasks(paths, chunk_size):
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), chunk_size):
+            yield path, start, min(start + chunk_size, size)
+
+class RecordWriter(object):
+    def __init__(self, f, format):
+        self.f = f
+        self.csv = None
+        if format == 'csv':
+            self.csv = csv.DictWriter(f, FIELDS)
+            self.csv.writeheader()
+
+    def write(self, record):
+        if self.csv is not None:
+            self.csv.writerow(record)
+        else:
+            self.f.write(json.dumps(record, sort_keys=True) + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract Volvo 850 mileage readings (B903 exchanges) from "
+                                                 "OBDwiz / TouchScan raw data and console logs and milageread output.")
+    parser.add_argument('paths', nargs='+',
+                      help="Log files, directories (searched recursively) or globs.")
+    parser.add_argument('--format', default='csv', choices=['csv', 'json'],
+                      help="csv (default) or json: one JSON object per line.")
+    parser.add_argument('--output',
+                      help="Write records here instead of stdout.")
+    parser.add_argument('--errors', action='store_true',
+                      help="Also write exchanges that gave no reading, with the reason.")
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                      help="Worker processes (default: one per CPU).")
+    parser.add_argument('--chunk-size', type=int, default=64,
+                      help="Split files into chunks of this many MB, scanned in parallel (default 64).")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+
+    paths = expand_paths(args.paths)
+    missing = [path for path in paths if not os.path.isfile(path)]
+    if missing:
+        sys.exit("No such file: " + ', '.join(missing))
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    writer = RecordWriter(out, args.format)
+    readings = failures = 0
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        for records in pool.imap(scan, tasks(paths, args.chunk_size * 1024 * 1024)):
+            for record in records:
+                if record['error']:
+                    failures = failures + 1
+                    if not args.errors: continue
+                else:
+                    readings = readings + 1
+                writer.write(record)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        sys.exit(1)
+    except:
+        # Don't wait for the workers to scan the rest of the logs.
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if out is not sys.stdout: out.close()
+    sys.stderr.write("{0} files, {1} readings, {2} B903 exchanges without a reading.\n".format(
+                     len(paths), readings, failures))
+
+if __name__ == '__main__':
+    main()
@@ -143,94 +143,925 @@
 #       Is similar to ELM327 format, except for addition of ":" after request,
 #       blank lines are eliminated, '>' prompt is eliminated.
 
+# milageread can also be used from Python, without the command line:
+#     import milageread
+#     reading = milageread.read_mileage('/dev/ttyUSB0')
+#     print(reading['miles'])
+# read_mileage() raises one of the ElmError subclasses below instead of
+# exiting.  serial (pyserial), argparse and socketserver are only imported
+# when they are needed, so importing milageread is cheap.
+
 import sys
-import serial
-import argparse
 import time
+import os
+import glob
+import json
+import threading
+import signal
+import stat
 
 lineshift = '\r\n'
-parser = argparse.ArgumentParser(description="Read milage from old Volvos using an ELM327 interface connected to the OBDII port.")
-parser.add_argument('port', metavar='P', 
-                  help="What port to connect to. In Windows this is usually a COM-port, and in Linux /dev/ttyUSBx or /dev/ttySx where x is the port number.")
-parser.add_argument('--debug', 
-                  action='store_true',
-                  help="Print debug info.")
-parser.add_argument('--dump', 
-                  action='store_true',
-                  help="Dump what milageread receives from ELM327.")
-parser.add_argument('-b', '--baud',
-                  nargs='?',
-                  const='38400',
-                  default='38400',
-                  choices=['38400', '115200'],
-                  help="Baud rate between computer and ELM327 -- only 38400 or 115200 allowed at present.",
-                  metavar='B')
-parser.add_argument('-v', '--version',
-                  action='version',
-                  version='milageread (w/ jonesrh enhancements thru 2017-09-23)')
-
-args = parser.parse_args()
-port = args.port
-debug = args.debug
-dump = args.dump
-baud = args.baud
-
-# Define array used for dumping in case it is needed.
-all_chars = bytearray()
-
-def elmcommand(command):
-    char = ' '
-    reply = ''
-    zero_bytes_counter = 0
-    ser.write(command + '\r') 
-    while char != '>':
+
+def hexbytes(data):
+    return ' '.join('{0:02X}'.format(b) for b in data)
+
+class ElmError(Exception):
+    # Raised when a read can't go on.  The session's messages up to that
+    # point are kept in messages; they say why, and what to try.
+    def __init__(self, message, messages=()):
+        Exception.__init__(self, message)
+        self.messages = list(messages)
+
+class NoAdapter(ElmError):
+    # The port can't be opened, or nothing there answers (wrong baud rate,
+    # adapter unplugged).
+    pass
+
+class UnsupportedAdapter(ElmError):
+    # What answers isn't an ELM327 that can talk KWPD3B0 to the COMBI.
+    pass
+
+class NoReading(ElmError):
+    # The adapter is fine, but the COMBI didn't give the mileage (ignition
+    # off, connection failed, corrupted or missing response).
+    pass
+
+class KwpDecoder(object):
+    # Decodes KWPD3B0 frames from the ELM327's text output (ATH1, so with
+    # header and checksum) as it arrives, a chunk at a time.  A frame is
+    #     format, target, source, data..., checksum
+    # where the low 6 bits of the format byte count the data bytes plus the
+    # checksum, eg "85 13 51 F9 03 5D 43 85".  Anything that isn't a two
+    # digit hex byte (the echo, "BUS INIT: ...OK", "<DATA ERROR") ends the
+    # frame in progress, and so does the end of a line: the ELM327 never
+    # splits a frame over lines.  Frames with a bad checksum are kept in
+    # rejected, never used.
+    def __init__(self, *response):
+        # The start of the data of the frame we are waiting for, eg F9 03.
+        self.response = bytearray(response)
+        self.token = ''
+        self.frame = bytearray()
+        self.frames = []
+        self.rejected = []
+        # Last frame was a "temporarily delayed" (7E/7F xx 23 or 78) response.
+        self.pending = False
+        # Response code of a negative (7E/7F) response other than that.
+        self.negative = None
+        # Data after self.response, once that frame is complete.
+        self.payload = None
+
+    @property
+    def done(self):
+        return self.payload is not None
+
+    def feed(self, text):
+        for char in text:
+            if char in ' \r\n<>':
+                self.word(self.token)
+                self.token = ''
+                if char in '\r\n': self.frame = bytearray()
+            else:
+                self.token = self.token + char
+
+    def word(self, token):
+        if token == '':
+            return
         try:
-            char = ser.read(1)
-        except:
-            # Need to display and/or check type of exception.
-            print("Failure in ser.read(1). Is baud rate correct? Has ELM327 disconnected?")
-            print("   Did you simply abort milageread with two Ctrl-C?")
-            sys.exit()
-        len_char = len(char)
-        if len_char != 1:
-            if len_char == 0: zero_bytes_counter = zero_bytes_counter + 1
-            print("ser.read(1) returned {0} bytes after 5 seconds.".format(len_char))
-            if zero_bytes_counter >= 3:
-                print("Can not read any bytes. Baud rate ({0}) assumed to be incorrect.".format(baud))
-                sys.exit()
+            value = int(token, 16) if len(token) == 2 else None
+        except ValueError:
+            value = None
+        if value is None:
+            self.frame = bytearray()
+            return
+        if not self.frame and not value & 0x80:
+            # Not a format byte, so not the start of a frame.
+            return
+        self.frame.append(value)
+        if len(self.frame) == (self.frame[0] & 0x3F) + 3:
+            self.complete(self.frame)
+            self.frame = bytearray()
+
+    def complete(self, frame):
+        if sum(frame[:-1]) & 0xFF != frame[-1]:
+            self.rejected.append(frame)
+            return
+        self.frames.append(frame)
+        data = frame[3:-1]
+        if len(data) >= 3 and data[0] in (0x7E, 0x7F) and data[-1] in (0x23, 0x78):
+            self.pending = True
+        elif len(data) >= 3 and data[0] in (0x7E, 0x7F) and self.response and data[1] == self.response[0] - 0x40:
+            self.pending = False
+            if self.negative is None: self.negative = data[-1]
+        elif data[:len(self.response)] == self.response:
+            self.pending = False
+            if self.payload is None: self.payload = data[len(self.response):]
         else:
-            if dump: all_chars.append(ord(char))
-            if (char != '>'): reply = reply + char
-    reply = reply.lstrip(lineshift)
-    if reply.find(command,0,len(command)) == 0:
-        reply = reply[len(command):]
-    reply = reply.lstrip(lineshift)
-    reply = reply.rstrip(lineshift + '>')
-    ##For offline testing:
-    ## Test #1 -- Multiline "BUS INIT: ...OK", then "7E B9 23" response,
-    ##            then "F9 03" response.
-    #if command == "B903":
-    #    reply = "BUS INIT: ...OK\r84 13 51 7e b9 23 42\r85 13 51 f9 03 5d 43 85"
-    ## Test #2 -- Single line concatenation of "7E B9 23" and "F9 03" responses,
-    ##            followed by "<DATA ERROR".
-    #if command == "B903":
-    #    reply = "84 13 51 7e b9 23 42 85 13 51 f9 03 5d 43 85 <DATA ERROR"
-    ## Test #3 -- Single line "BUS INIT: ...ERROR".
-    #if command == "B903":
-    #    reply = "BUS INIT: ...ERROR"
-    if debug: print (command + ': ' + reply.replace('\r',lineshift))
-    return(reply)
-
-def init():
-    elmcheck = elmcommand('ATRV')
-    elmcheck = elmcommand('ATZ')
-    if 'ELM327' in elmcheck:
-        print('Initialized device: ' + elmcheck)
-    else:
-        print("No ELM327 device found.")
-        ser.close()
-        sys.exit()
+            self.pending = False
+
+def kwp_header(ecu, request):
+    # ATSH for sending request to ecu from the tester (13): the low 6 bits
+    # of the format byte count the data bytes plus the checksum.
+    return 'ATSH {0:02X} {1:02X} 13'.format(0x80 | (len(request) + 1), ecu)
+
+def kwp_response(request):
+    # What a positive response starts with: the service ID + 0x40, then
+    # the rest of the request echoed, eg F9 03 for B9 03.
+    return bytearray([(request[0] + 0x40) & 0xFF]) + bytearray(request[1:])
+
+def parse_request(spec):
+    # "51:B903" or "51:B9 03" -> (0x51, bytearray(b'\xb9\x03')).
+    ecu, _, request = spec.partition(':')
+    ecu = int(ecu, 16)
+    request = bytearray.fromhex(request.replace(' ', ''))
+    if not request or not 0 <= ecu <= 0xFF:
+        raise ValueError(spec)
+    return ecu, request
+
+def decode_milage(payload):
+    # The data after F9 03 is the odometer in tens of miles, low byte first.
+    miles = (payload[1] << 8 | payload[0]) * 10
+    return miles, int(miles * 1.609344)
+
+def escape_bytes(data):
+    # Printable ASCII as is, \r and \n as such, anything else as \xNN.
+    out = []
+    for b in bytearray(data):
+        if b == 0x0D: out.append('\\r')
+        elif b == 0x0A: out.append('\\n')
+        elif b == 0x5C: out.append('\\\\')
+        elif 0x20 <= b < 0x7F: out.append(chr(b))
+        else: out.append('\\x{0:02x}'.format(b))
+    return ''.join(out)
+
+def unescape_bytes(text):
+    data = bytearray()
+    i = 0
+    while i < len(text):
+        if text[i] == '\\' and i + 1 < len(text):
+            c = text[i + 1]
+            if c == 'x':
+                data.append(int(text[i + 2:i + 4], 16))
+                i = i + 4
+                continue
+            data.append({'r': 0x0D, 'n': 0x0A}.get(c, ord(c)))
+            i = i + 2
+        else:
+            data.append(ord(text[i]))
+            i = i + 1
+    return bytes(data)
+
+# time.monotonic is not available before Python 3.3.
+monotonic = getattr(time, 'monotonic', time.time)
+
+class CaptureWriter(object):
+    # Streams all traffic with the adapter to a file as it happens, one
+    # line per write or read:
+    #     <seconds since start> tx|rx <data escaped by escape_bytes()>
+    # Nothing is kept in memory, so a capture can run as long as a --serve
+    # or --poll session does.  read_capture() reads it back; elm327emu.py
+    # --replay answers like the captured adapter did.
+    def __init__(self, path, port, baud):
+        self.f = open(path, 'w')
+        self.start = monotonic()
+        self.f.write("# milageread capture: port {0}, {1} baud, started {2}\n".format(
+                     port, baud, time.strftime('%Y-%m-%d %H:%M:%S')))
+
+    def write(self, direction, data):
+        if self.f is None: return
+        self.f.write("{0:.6f} {1} {2}\n".format(monotonic() - self.start, direction, escape_bytes(data)))
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+def read_capture(path):
+    # Yields (seconds, 'tx' or 'rx', bytes) for each line of a capture file.
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'): continue
+            line = line.rstrip('\n')
+            seconds, direction, data = line.split(' ', 2)
+            yield float(seconds), direction, unescape_bytes(data)
+
+class AdapterCache(object):
+    # What init() learned about each adapter, kept in a JSON file between
+    # runs: whether it passed the KWPD3B0 setup (and which commands failed if
+    # not), its version string, and when it was last configured.  Keyed by
+    # port + ATI + AT@1.  Safe to share between fleet mode threads.
+    def __init__(self, path, ttl=600):
+        self.path = path
+        # Trust a configuration for this many seconds after the full init.
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self, entries):
+        # Write to a temporary file first so a crash never leaves a truncated
+        # cache behind.
+        tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entries, f, indent=1, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(self.path): os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def get(self, key):
+        with self.lock:
+            return self.load().get(key)
+
+    def put(self, key, entry):
+        with self.lock:
+            entries = self.load()
+            entries[key] = entry
+            self.save(entries)
+
+    def forget(self, key):
+        with self.lock:
+            entries = self.load()
+            if entries.pop(key, None) is not None:
+                self.save(entries)
+
+    def fresh(self, entry):
+        return time.time() - entry.get('configured', 0) < self.ttl
+
+# What the ELM327 answers when something went wrong, most specific first.
+reply_errors = ['BUS INIT: ...ERROR', 'BUS INIT: BUS ERROR', 'BUS ERROR', 'DATA ERROR', 'RX ERROR',
+                'CAN ERROR', 'BUFFER FULL', 'UNABLE TO CONNECT', 'NO DATA', 'STOPPED', '?']
+
+def reply_error(reply):
+    # The error in an ELM327 reply, or None.
+    for error in reply_errors:
+        if error in reply:
+            return error
+    return None
+
+class Metrics(object):
+    # Timings, byte counts, retries and errors of any number of sessions
+    # (fleet mode threads), kept per port.  Every event is also appended to
+    # a JSON lines file as it happens, if one is given, and after every read
+    # the totals are written to a Prometheus text format file (eg for
+    # node_exporter's textfile collector).  A session without a Metrics
+    # object skips all of this.
+    read_buckets = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+    def __init__(self, jsonl=None, prometheus=None):
+        self.jsonl = open(jsonl, 'a') if jsonl else None
+        self.prometheus_path = prometheus
+        self.lock = threading.Lock()
+        # {(port, command): [count, seconds, longest, tx bytes, rx bytes]}
+        self.commands = {}
+        # {(port, phase): [count, seconds]}
+        self.phases = {}
+        # {(port, what): count}
+        self.retries = {}
+        # {(port, command, error): count}
+        self.errors = {}
+        # {(port, outcome): [count, seconds, [count per bucket]]}
+        self.reads = {}
+
+    def event(self, kind, port, **fields):
+        if self.jsonl is None: return
+        fields.update({'time': round(time.time(), 3), 'event': kind, 'port': port})
+        self.jsonl.write(json.dumps(fields, sort_keys=True) + '\n')
+        self.jsonl.flush()
+
+    def command(self, port, command, seconds, tx, rx):
+        with self.lock:
+            entry = self.commands.setdefault((port, command), [0, 0.0, 0.0, 0, 0])
+            entry[0] = entry[0] + 1
+            entry[1] = entry[1] + seconds
+            entry[2] = max(entry[2], seconds)
+            entry[3] = entry[3] + tx
+            entry[4] = entry[4] + rx
+            self.event('command', port, command=command, seconds=round(seconds, 4), tx=tx, rx=rx)
+
+    def phase(self, port, phase, seconds):
+        with self.lock:
+            entry = self.phases.setdefault((port, phase), [0, 0.0])
+            entry[0] = entry[0] + 1
+            entry[1] = entry[1] + seconds
+            self.event('phase', port, phase=phase, seconds=round(seconds, 4))
+
+    def retry(self, port, what):
+        with self.lock:
+            self.retries[(port, what)] = self.retries.get((port, what), 0) + 1
+            self.event('retry', port, retry=what)
+
+    def error(self, port, command, error):
+        with self.lock:
+            self.errors[(port, command, error)] = self.errors.get((port, command, error), 0) + 1
+            self.event('error', port, command=command, error=error)
+
+    def read(self, port, seconds, outcome):
+        # outcome is 'ok' or the name of the exception that ended the read.
+        with self.lock:
+            entry = self.reads.setdefault((port, outcome), [0, 0.0, [0] * len(self.read_buckets)])
+            entry[0] = entry[0] + 1
+            entry[1] = entry[1] + seconds
+            for i, bucket in enumerate(self.read_buckets):
+                if seconds <= bucket: entry[2][i] = entry[2][i] + 1
+            self.event('read', port, seconds=round(seconds, 4), outcome=outcome)
+            if self.prometheus_path: self.save()
+
+    def prometheus(self):
+        # The totals in the Prometheus text exposition format.
+        def labels(**values):
+            return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in sorted(values.items())) + '}'
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            lines.extend(samples)
+        metric('milageread_read_seconds', 'histogram', 'Time from opening the port (or from the request, on an open connection) to the result.',
+               ['milageread_read_seconds_bucket{0} {1}'.format(labels(port=port, outcome=outcome, le=bucket), count)
+                for (port, outcome), entry in sorted(self.reads.items())
+                for bucket, count in zip(self.read_buckets + ['+Inf'], entry[2] + [entry[0]])] +
+               ['milageread_read_seconds_{0}{1} {2}'.format(stat, labels(port=port, outcome=outcome), value)
+                for (port, outcome), entry in sorted(self.reads.items())
+                for stat, value in (('sum', entry[1]), ('count', entry[0]))])
+        metric('milageread_phase_seconds', 'summary', 'Time spent in open, init, milageread and batch.',
+               ['milageread_phase_seconds_{0}{1} {2}'.format(stat, labels(port=port, phase=phase), value)
+                for (port, phase), entry in sorted(self.phases.items())
+                for stat, value in (('sum', entry[1]), ('count', entry[0]))])
+        metric('milageread_command_seconds', 'summary', 'Time from sending a command to the ELM327 to its reply.',
+               ['milageread_command_seconds_{0}{1} {2}'.format(stat, labels(port=port, command=command), value)
+                for (port, command), entry in sorted(self.commands.items())
+                for stat, value in (('sum', entry[1]), ('count', entry[0]))])
+        metric('milageread_command_seconds_max', 'gauge', 'Longest time a command took.',
+               ['milageread_command_seconds_max{0} {1}'.format(labels(port=port, command=command), entry[2])
+                for (port, command), entry in sorted(self.commands.items())])
+        metric('milageread_bytes_total', 'counter', 'Bytes sent to and received from the ELM327 by commands.',
+               ['milageread_bytes_total{0} {1}'.format(labels(port=port, command=command, direction=direction), value)
+                for (port, command), entry in sorted(self.commands.items())
+                for direction, value in (('tx', entry[3]), ('rx', entry[4]))])
+        metric('milageread_retries_total', 'counter', 'Requests sent again after a BUS INIT failure.',
+               ['milageread_retries_total{0} {1}'.format(labels(port=port, retry=what), count)
+                for (port, what), count in sorted(self.retries.items())])
+        metric('milageread_errors_total', 'counter', 'ELM327 error replies and timeouts, by command.',
+               ['milageread_errors_total{0} {1}'.format(labels(port=port, command=command, error=error), count)
+                for (port, command, error), count in sorted(self.errors.items())])
+        return '\n'.join(lines) + '\n'
+
+    def save(self):
+        # Replace the file in one go, so a collector never reads half of it.
+        tmp = '{0}.{1}.tmp'.format(self.prometheus_path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        if os.name == 'nt' and os.path.exists(self.prometheus_path): os.remove(self.prometheus_path)
+        os.rename(tmp, self.prometheus_path)
+
+    def close(self):
+        with self.lock:
+            if self.prometheus_path: self.save()
+            if self.jsonl is not None:
+                self.jsonl.close()
+                self.jsonl = None
+
+class ResultStore(object):
+    # Every read (readings and failures) in an SQLite database: when, port,
+    # vehicle label, adapter version (ATZ), the raw B903 reply, miles,
+    # kilometers and, for a failure, the ElmError class.  Writes are batched
+    # (up to batch_size readings or flush_interval seconds, and on close())
+    # and the database is in WAL mode, so reports can query it while fleet
+    # reads go on.  Safe to share between fleet mode threads.
+    columns = ['time', 'port', 'vehicle', 'adapter', 'raw', 'miles', 'kilometers', 'error']
+    batch_size = 50
+    flush_interval = 5.0
+
+    def __init__(self, path):
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER PRIMARY KEY, time REAL NOT NULL, '
+                            'port TEXT, vehicle TEXT, adapter TEXT, raw TEXT, miles INTEGER, kilometers INTEGER, '
+                            'error TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS readings_vehicle ON readings (vehicle, time)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS readings_port ON readings (port, time)')
+        self.lock = threading.Lock()
+        self.pending = []
+        # Writes the pending readings flush_interval seconds after the first
+        # of them, even if no more reads come (--serve, --poll).
+        self.timer = None
+
+    def add(self, reading):
+        with self.lock:
+            self.pending.append(tuple(reading.get(column) for column in self.columns))
+            if len(self.pending) >= self.batch_size:
+                self.write_pending()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def write_pending(self):
+        # Caller holds self.lock.  One transaction for the whole batch.
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            with self.db:
+                self.db.executemany('INSERT INTO readings ({0}) VALUES ({1})'.format(
+                                    ', '.join(self.columns), ', '.join('?' * len(self.columns))), self.pending)
+            self.pending = []
+
+    def close(self):
+        with self.lock:
+            self.write_pending()
+            self.db.close()
+            self.db = None
+
+    def flush(self):
+        with self.lock:
+            if self.db is not None: self.write_pending()
+
+    def history(self, vehicle=None, port=None, errors=False):
+        # Readings of one vehicle (or port, or all), oldest first, as dicts.
+        self.flush()
+        where = ['1']
+        args = []
+        if vehicle is not None:
+            where.append('vehicle = ?')
+            args.append(vehicle)
+        if port is not None:
+            where.append('port = ?')
+            args.append(port)
+        if not errors:
+            where.append('miles IS NOT NULL')
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM readings WHERE {0} ORDER BY time'.format(' AND '.join(where)), args)
+            return [dict(row) for row in rows]
+
+    def anomalies(self, vehicle=None, max_miles_per_day=1500):
+        # Consecutive readings of the same vehicle where the odometer went
+        # back (rollback), or went forward faster than anyone drives (jump).
+        # Only labelled readings count: the cars on one port are different
+        # cars.  Yields dicts with kind, vehicle, and the readings before and
+        # after.
+        self.flush()
+        where, args = ('vehicle = ?', [vehicle]) if vehicle is not None else ('vehicle IS NOT NULL', [])
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM readings WHERE miles IS NOT NULL AND {0} '
+                                   'ORDER BY vehicle, time'.format(where), args).fetchall()
+        last = None
+        for row in rows:
+            if last is not None and last['vehicle'] == row['vehicle']:
+                days = max(row['time'] - last['time'], 3600) / 86400.0
+                kind = None
+                if row['miles'] < last['miles']:
+                    kind = 'rollback'
+                elif row['miles'] - last['miles'] > max_miles_per_day * days:
+                    kind = 'jump'
+                if kind:
+                    yield {'kind': kind, 'vehicle': row['vehicle'], 'before': dict(last), 'after': dict(row)}
+            last = row
+
+class RetryPolicy(object):
+    # How milageread() recovers from "BUS INIT: ...ERROR": ATPC, wait, B903
+    # again.  The defaults give the classic single retry after 5.1 seconds,
+    # except that the wait ends early when ATRV polling sees the ignition
+    # being switched on.
+    def __init__(self, attempts=2, delay=5.1, backoff=1.0, max_delay=10.0,
+                 deadline=30.0, poll=0.5, voltage_step=0.4, settle=2.0):
+        # Total number of B903 attempts, including the first one.
+        self.attempts = attempts
+        # Wait before the first retry, multiplied by backoff for every
+        # following one, but never more than max_delay.
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        # No retries are started later than this many seconds after the
+        # first "...ERROR".
+        self.deadline = deadline
+        # ATRV polling interval while waiting, the voltage change (in volts)
+        # taken as ignition on (0 disables polling), and how long the COMBI
+        # is then given to wake up.
+        self.poll = poll
+        self.voltage_step = voltage_step
+        self.settle = settle
+
+    def delays(self):
+        delay = self.delay
+        for _ in range(self.attempts - 1):
+            yield min(delay, self.max_delay)
+            delay = delay * self.backoff
+
+class ElmSession(object):
+    # Everything belonging to one ELM327 on one port.  Keeping this out of
+    # module globals lets fleet mode drive several adapters side by side.
+
+    # Rates tried by baud 'auto', most common first.
+    baud_candidates = [38400, 115200, 9600, 57600, 230400, 500000]
+
+    # Seconds ser.read waits for data, by command prefix (the longest
+    # matching prefix wins).  AT commands other than resets answer at once;
+    # '' covers the KWP requests to the COMBI, where B903 may have to wait
+    # for the BUS INIT and for "7E B9 23" (temporarily delayed) responses.
+    command_timeouts = {'': 5.0,
+                        'AT': 1.0,
+                        'ATZ': 5.0,
+                        'ATWS': 5.0}
+    def __init__(self, port, baud='38400', debug=False, dump=False, echo=True, cache=None, retry=None,
+                 keepalive=None, baud_upgrade=None, timeouts=None, adaptive_timing=None, st=None,
+                 capture=None, requests=None, metrics=None, store=None, vehicle=None):
+        self.port = port
+        self.baud = baud
+        self.debug = debug
+        self.dump = dump
+        # With echo off, messages are only collected in self.messages so
+        # that concurrent sessions don't interleave their output.
+        self.echo = echo
+        self.messages = []
+        self.ser = None
+        self.result = None
+        # ATZ identification of the adapter, once init() has run, and the
+        # init commands it failed (if any, it can't do KWPD3B0).
+        self.version = None
+        self.failed_commands = []
+        # Optional CaptureWriter recording all traffic with the adapter.
+        self.capture = capture
+        # Optional Metrics recording timings, bytes, retries and errors.
+        self.metrics = metrics
+        # Optional ResultStore that every read is written to, labelled with
+        # vehicle, and the B903 reply of the last read.
+        self.store = store
+        self.vehicle = vehicle
+        self.raw = None
+        # Bytes received so far, and the command being waited for.
+        self.rx_bytes = 0
+        self.command = ''
+        # Receive buffer shared by all elmcommand() calls.  Anything the ELM327
+        # sends after a '>' prompt stays here for the next command instead of
+        # being lost.
+        self.rxbuf = bytearray()
+        # Optional AdapterCache that lets init() skip the reset and the init
+        # commands for an adapter that is still configured from a previous run.
+        self.cache = cache
+        self.cache_key = None
+        self.cached_init = False
+        self.retry = retry if retry is not None else RetryPolicy()
+        # Whether a KWPD3B0 connection to the COMBI was left open by
+        # milageread(keep_session=True), and whether end_session() has
+        # replaced the B903 request header since init().
+        self.kwp_open = False
+        self.need_header = False
+        self.new_connection = False
+        # ECU that ATIIA / ATWM are set up for; see select_ecu().
+        self.ecu = 0x51
+        # Extra (ecu, request) pairs that run() reads after the mileage
+        # over the same connection, and their results (see read_batch()).
+        self.requests = list(requests or [])
+        self.batch = None
+        # Rate to raise the link to with ATBRD after init (None: don't), and
+        # the rate to return to before closing the port.
+        self.baud_upgrade = baud_upgrade
+        self.upgraded_from = None
+        self.timeouts = dict(self.command_timeouts)
+        if timeouts: self.timeouts.update(timeouts)
+        self.timing = {}
+        self.longest_wait = 0.0
+        # Whether read_until_prompt() returned early and the ELM327's prompt
+        # for that command is still to come.
+        self.prompt_pending = False
+        if keepalive is not None:
+            # Period in ms of the ATWM wakeup message the ELM327 sends by
+            # itself to keep an open connection alive (ATSW, 20 ms units).
+            self.initcommands = self.initcommands + ['ATSW {0:02X}'.format(max(1, min(255, int(keepalive) // 20)))]
+        if adaptive_timing is not None:
+            # ATAT1/ATAT2 let the ELM327 shorten its wait for further frames
+            # to what the COMBI actually needs; ATAT0 always waits ATST.
+            self.initcommands = self.initcommands + ['ATAT{0}'.format(adaptive_timing)]
+        if st is not None:
+            # Longest wait for another frame after the last one, in 4.096 ms
+            # units (ELM327 default 32 hex, about 200 ms).
+            self.initcommands = self.initcommands + ['ATST {0:02X}'.format(max(1, min(255, int(-(-st // 4.096)))))]
+
+    def out(self, msg):
+        msg = str(msg)
+        self.messages.append(msg)
+        if self.echo: print(msg)
+
+    def open(self, probe_timeout=0.3):
+        # probe_timeout: how long each ATI waits at each rate with baud 'auto'.
+        self.out("Attempting communication...")
+        import serial
+        try:
+            baud = self.baud_candidates[0] if self.baud == 'auto' else int(self.baud)
+            self.ser = serial.Serial(self.port, baud, timeout=5)
+        except:
+            self.out("Failed to open port {0} at {1} baud. ELM327 not connected? Wrong port #?".format(self.port, self.baud))
+            return False
+        if self.baud == 'auto' and not self.detect_baud(probe_timeout):
+            self.ser.close()
+            return False
+        return True
+
+    def timing_report(self):
+        # Longest wait seen per timeout profile entry against its timeout.
+        self.out("Timeout profile (longest wait for data / timeout):")
+        for key in sorted(self.timing):
+            self.out("    {0:6s} {1:6.3f} / {2:g} s".format(key or 'KWP', self.timing[key], self.timeouts[key]))
+
+    def close(self):
+        if self.debug and self.timing: self.timing_report()
+        if self.ser is not None:
+            if self.upgraded_from is not None and self.ser.is_open:
+                self.drain_prompt()
+                # Leave the adapter at the rate the next run will expect.
+                self.upgrade_baud(self.upgraded_from)
+            self.ser.close()
+        if self.capture is not None: self.capture.close()
+
+    def send(self, data):
+        if self.capture is not None: self.capture.write('tx', data)
+        try:
+            self.ser.write(data)
+        except (IOError, OSError):
+            # pyserial's SerialException is an IOError.
+            self.out("Failure in ser.write. Has ELM327 disconnected?")
+            raise NoAdapter("Lost ELM327 on {0}.".format(self.port), self.messages)
+
+    def received(self, chunk):
+        # Everything read from the adapter passes through here.  --dump shows
+        # it as it arrives, with CR and LF expanded, to:
+        # - determine how to handle CR and LF for different platforms, and
+        # - just to see exactly what ELM327 is sending when ATL0 / ATE1 is used
+        #   (and when other ATLx / ATEx variations are used).
+        self.rx_bytes = self.rx_bytes + len(chunk)
+        if self.capture is not None: self.capture.write('rx', chunk)
+        if self.dump: self.out("Rcvd: " + escape_bytes(chunk))
+
+    def read_for(self, terminators, timeout):
+        # Read until one of terminators has arrived or timeout seconds have
+        # passed.  Returns everything read, or None on timeout.  Unlike
+        # read_until_prompt() this never gives up on the whole session.
+        saved_timeout = self.ser.timeout
+        deadline = time.time() + timeout
+        data = bytearray()
+        try:
+            while not any(t in data for t in terminators):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    self.ser.timeout = remaining
+                    chunk = self.ser.read(self.ser.in_waiting or 1)
+                except (IOError, OSError):
+                    self.out("Failure in ser.read. Has ELM327 disconnected?")
+                    raise NoAdapter("Lost ELM327 on {0}.".format(self.port), self.messages)
+                self.received(chunk)
+                data.extend(chunk)
+        finally:
+            self.ser.timeout = saved_timeout
+        return data
+
+    def probe(self, command, timeout):
+        # Send command and return its reply up to the '>' prompt, or None if
+        # no prompt came within timeout seconds.
+        self.ser.reset_input_buffer()
+        del self.rxbuf[:]
+        self.send((command + '\r').encode('ascii'))
+        reply = self.read_for((b'>',), timeout)
+        if reply is None:
+            return None
+        return reply[:reply.find(b'>')].decode('ascii', 'replace')
+
+    def detect_baud(self, timeout=0.3):
+        # Try each candidate rate with a short ATI probe instead of waiting
+        # out three 5-second timeouts at a wrong rate.
+        for rate in self.baud_candidates:
+            self.ser.baudrate = rate
+            # At the right rate a first ATI may still be garbled by noise
+            # left in the adapter's input from probes at other rates, so a
+            # prompt without "ELM327" earns a second try.
+            for attempt in range(2):
+                reply = self.probe('ATI', timeout)
+                if reply is None:
+                    break
+                if 'ELM327' in reply:
+                    self.baud = str(rate)
+                    self.out("Found ELM327 at {0} baud.".format(rate))
+                    return True
+        self.out("No ELM327 answered at {0} baud. ELM327 not connected? Wrong port #?".format(
+                 ', '.join(str(rate) for rate in self.baud_candidates)))
+        return False
+
+    def upgrade_baud(self, rate):
+        # ATBRD hh: the ELM327 answers OK at the current rate, switches to
+        # 4 MHz / hh and sends its ATI string at the new rate, then switches
+        # back unless a CR comes back at the new rate within ATBRT (75 ms by
+        # default).  Returns whether the link now runs at the new rate.
+        divisor = int(round(4000000.0 / rate))
+        old_rate = self.ser.baudrate
+        new_rate = int(round(4000000.0 / divisor))
+        if not 8 <= divisor <= 0xFF or abs(new_rate - old_rate) <= 0.02 * old_rate:
+            return False
+        self.ser.reset_input_buffer()
+        del self.rxbuf[:]
+        self.send('ATBRD {0:02X}\r'.format(divisor).encode('ascii'))
+        reply = self.read_for((b'OK', b'>'), 1.0)
+        if reply is None or b'OK' not in reply:
+            self.out("ELM327 does not accept {0} baud (ATBRD {1:02X}); staying at {2} baud.".format(new_rate, divisor, old_rate))
+            if reply is None: self.read_for((b'>',), 1.0)
+            return False
+        self.ser.baudrate = new_rate
+        # Only the CR ending the ATI string matters; its first characters may
+        # be lost while the UART switches.
+        reply = self.read_for((b'\r',), 0.5)
+        if reply is not None:
+            self.send(b'\r')
+            reply = self.read_for((b'>',), 1.0)
+        if reply is None or b'OK' not in reply:
+            self.ser.baudrate = old_rate
+            self.read_for((b'>',), 1.0)
+            self.out("Could not switch to {0} baud; staying at {1} baud.".format(new_rate, old_rate))
+            return False
+        if self.upgraded_from is None:
+            self.upgraded_from = old_rate
+        elif abs(new_rate - self.upgraded_from) <= 0.02 * self.upgraded_from:
+            self.upgraded_from = None
+        self.baud = str(new_rate)
+        self.out("Switched to {0} baud.".format(new_rate))
+        return True
+
+    def run(self):
+        # Open the port, read the mileage, close the port.  Returns
+        # (miles, kilometers), or raises an ElmError saying what failed.
+        start = time.time()
+        outcome = 'ok'
+        try:
+            if not self.timed('open', self.open):
+                raise NoAdapter("Failed to open port {0}.".format(self.port), self.messages)
+            try:
+                if not self.timed('init', self.init):
+                    raise UnsupportedAdapter("ELM327 device can not do KWPD3B0.", self.messages)
+                self.result = self.read(bool(self.requests))
+                if self.result is None:
+                    raise NoReading("No mileage from the COMBI.", self.messages)
+                if self.requests:
+                    self.batch = self.timed('batch', self.read_batch, self.requests)
+            finally:
+                self.close()
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            self.record_read(time.time() - start, outcome)
+        return self.result
+
+    def read(self, keep_session=False):
+        # milageread(), for run(), ReadServer and poll().  If the read fails
+        # right after a cached init, the adapter was maybe power cycled and
+        # lost its settings (see probe_configured()): forget them, do the
+        # full init and read once more.  Raises UnsupportedAdapter if the
+        # full init fails.
+        result = self.timed('milageread', self.milageread, keep_session)
+        if self.cached_init:
+            # Whatever happens now, the cached configuration has had its
+            # chance; later failures get the usual retries.
+            self.cached_init = False
+            if result is None:
+                self.out("Read failed with the cached configuration. Initializing the ELM327 again...")
+                self.cache.forget(self.cache_key)
+                if not self.timed('init', self.init):
+                    raise UnsupportedAdapter("ELM327 device can not do KWPD3B0.", self.messages)
+                result = self.timed('milageread', self.milageread, keep_session)
+        return result
+
+    def record_read(self, seconds, outcome):
+        # outcome is 'ok' or the name of the ElmError that ended the read.
+        if self.metrics is not None: self.metrics.read(self.port, seconds, outcome)
+        if self.store is not None:
+            ok = outcome == 'ok' and self.result is not None
+            self.store.add({'time': time.time(),
+                            'port': self.port,
+                            'vehicle': self.vehicle,
+                            'adapter': self.version,
+                            'raw': self.raw,
+                            'miles': self.result[0] if ok else None,
+                            'kilometers': self.result[1] if ok else None,
+                            'error': None if ok else outcome})
+        self.raw = None
+
+    def timed(self, phase, method, *args):
+        # method(*args), timed as phase if metrics are being kept.
+        if self.metrics is None:
+            return method(*args)
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.metrics.phase(self.port, phase, time.time() - start)
 
+    def read_until_prompt(self, decoder=None):
+        # Read everything up to the ELM327's '>' prompt.  Block for the first
+        # byte, then take whatever else is already waiting in one ser.read, so a
+        # multi-line reply costs a handful of reads instead of one per byte.
+        # With a KwpDecoder, return as soon as it has the response it waits
+        # for; the prompt is then collected before the next command.
+        zero_bytes_counter = 0
+        searched = 0
+        # Longest single wait for data, to check the timeout profile with.
+        self.longest_wait = 0.0
+        while True:
+            iprompt = self.rxbuf.find(b'>', searched)
+            if iprompt != -1:
+                break
+            if decoder is not None and decoder.done:
+                reply = self.rxbuf.decode('ascii', 'replace')
+                del self.rxbuf[:]
+                self.prompt_pending = True
+                return reply
+            searched = len(self.rxbuf)
+            start = time.time()
+            try:
+                chunk = self.ser.read(self.ser.in_waiting or 1)
+                self.longest_wait = max(self.longest_wait, time.time() - start)
+            except:
+                # Need to display and/or check type of exception.
+                self.out("Failure in ser.read. Is baud rate correct? Has ELM327 disconnected?")
+                self.out("   Did you simply abort milageread with two Ctrl-C?")
+                raise NoAdapter("Lost ELM327 on {0}.".format(self.port), self.messages)
+            if len(chunk) == 0:
+                zero_bytes_counter = zero_bytes_counter + 1
+                self.out("ser.read returned 0 bytes after {0:g} seconds.".format(self.ser.timeout))
+                if self.metrics is not None: self.metrics.error(self.port, self.command, 'timeout')
+                if zero_bytes_counter >= 3:
+                    self.out("Can not read any bytes. Baud rate ({0}) assumed to be incorrect.".format(self.baud))
+                    raise NoAdapter("No answer from {0} at {1} baud.".format(self.port, self.baud), self.messages)
+                continue
+            self.received(chunk)
+            self.rxbuf.extend(chunk)
+            if decoder is not None: decoder.feed(chunk.decode('ascii', 'replace'))
+        reply = self.rxbuf[:iprompt].decode('ascii', 'replace')
+        del self.rxbuf[:iprompt + 1]
+        return reply
+
+    def timeout_for(self, command):
+        # The profile entry with the longest prefix of command; '' always
+        # matches.
+        key = max((k for k in self.timeouts if command.startswith(k)), key=len)
+        return key, self.timeouts[key]
+
+    def drain_prompt(self):
+        # The ELM327 must have finished the previous command (and sent its
+        # prompt) before it is sent another one, or it aborts with STOPPED.
+        if self.prompt_pending:
+            self.prompt_pending = False
+            self.read_until_prompt()
+
+    def elmcommand(self, command, decoder=None):
+        self.drain_prompt()
+        key, timeout = self.timeout_for(command)
+        if self.ser.timeout != timeout: self.ser.timeout = timeout
+        self.command = command
+        if self.metrics is not None:
+            start = time.time()
+            rx_bytes = self.rx_bytes
+        self.send((command + '\r').encode('ascii'))
+        reply = self.read_until_prompt(decoder)
+        if self.metrics is not None:
+            self.metrics.command(self.port, command, time.time() - start, len(command) + 1, self.rx_bytes - rx_bytes)
+            error = reply_error(reply)
+            if error is not None: self.metrics.error(self.port, command, error)
+        longest = self.timing.get(key, 0.0)
+        if self.longest_wait > longest:
+            self.timing[key] = self.longest_wait
+            if self.longest_wait > 0.8 * timeout and longest <= 0.8 * timeout:
+                self.out("{0} waited {1:.2f} seconds for data, close to its {2:g} second timeout. "
+                         "Consider --timeout {3}=<seconds>.".format(command, self.longest_wait, timeout, key or 'KWP'))
+        reply = reply.lstrip(lineshift)
+        if reply.find(command,0,len(command)) == 0:
+            reply = reply[len(command):]
+        reply = reply.lstrip(lineshift)
+        reply = reply.rstrip(lineshift + '>')
+        ##For offline testing:
+        ## Test #1 -- Multiline "BUS INIT: ...OK", then "7E B9 23" response,
+        ##            then "F9 03" response.
+        #if command == "B903":
+        #    reply = "BUS INIT: ...OK\r84 13 51 7e b9 23 42\r85 13 51 f9 03 5d 43 85"
+        ## Test #2 -- Single line concatenation of "7E B9 23" and "F9 03" responses,
+        ##            followed by "<DATA ERROR".
+        #if command == "B903":
+        #    reply = "84 13 51 7e b9 23 42 85 13 51 f9 03 5d 43 85 <DATA ERROR"
+        ## Test #3 -- Single line "BUS INIT: ...ERROR".
+        #if command == "B903":
+        #    reply = "BUS INIT: ...ERROR"
+        if self.debug: self.out(command + ': ' + reply.replace('\r',lineshift))
+        return(reply)
+
+    # Commands that set up the ELM327 for KWPD3B0 communication with the
+    # COMBI (ECU 51), sent by init() after the ATZ.
     initcommands = ['ATL0',
                     'ATE1',
                     'ATSP 3',
@@ -241,212 +1072,1032 @@ def init():
                     'ATIIA 51',
                     'ATWM 82 51 13 A1',
                     'ATSH 83 51 13']
-    # Detect deficient ELM327 devices and inform user of deficient command(s).
-    failed_kwpd3b0_setup_cmds = ''
-    for command in initcommands:
-        elmreply = elmcommand(command)
-        if ('?' in elmreply) or ((command == 'ATIIA 51') and (elmreply != 'OK')):
-            if (failed_kwpd3b0_setup_cmds == '') or (debug):
-                print("Your ELM327 device is not functionally equivalent to ELM327 v1.2 (or higher).")
-                if not debug:
-                    print("It failed to understand and correctly respond to the following command(s):")
-                else:
-                    if ('?' in elmreply):
-                        print("It failed to understand the following command:")
+
+    def init(self):
+        elmcheck = self.elmcommand('ATRV')
+        if self.cache is not None:
+            self.cache_key = self.identify()
+            entry = self.cache.get(self.cache_key)
+            if entry is not None and not entry['ok'] and not self.still_deficient(entry):
+                # Another adapter with the same ATI / AT@1 strings (clones
+                # often share them), or the entry has expired: find out anew.
+                self.cache.forget(self.cache_key)
+                entry = None
+            if entry is not None and not entry['ok']:
+                # Known KWPD3B0-deficient adapter: reject it without the reset
+                # and the whole init list.
+                self.out("Your ELM327 device ({0}) is known from an earlier run to not be".format(entry['version']))
+                self.out("functionally equivalent to ELM327 v1.2 (or higher).")
+                self.out("It failed to understand and correctly respond to the following command(s):")
+                for command in entry['failed']:
+                    self.out("    " + command)
+                self.failed_commands = entry['failed']
+                self.print_kwpd3b0_commands()
+                return False
+            if entry is not None and self.cache.fresh(entry) and \
+               entry.get('commands') == self.initcommands and self.probe_configured():
+                self.out('Initialized device: ' + entry['version'] + ' (cached configuration)')
+                self.version = entry['version']
+                self.cached_init = True
+                if self.baud_upgrade: self.upgrade_baud(self.baud_upgrade)
+                return True
+
+        elmcheck = self.elmcommand('ATZ')
+        if 'ELM327' in elmcheck:
+            self.out('Initialized device: ' + elmcheck)
+            self.version = elmcheck.strip()
+        else:
+            self.out("No ELM327 device found.")
+            raise UnsupportedAdapter("No ELM327 device found on {0}.".format(self.port), self.messages)
+
+        # Detect deficient ELM327 devices and inform user of deficient command(s).
+        failed_kwpd3b0_setup_cmds = ''
+        for command in self.initcommands:
+            elmreply = self.elmcommand(command)
+            if self.command_failed(command, elmreply):
+                if (failed_kwpd3b0_setup_cmds == '') or (self.debug):
+                    self.out("Your ELM327 device is not functionally equivalent to ELM327 v1.2 (or higher).")
+                    if not self.debug:
+                        self.out("It failed to understand and correctly respond to the following command(s):")
                     else:
-                        # This is a more accurate message for the "ATIIA 51" responding with "ELM327 v2.1" (instead of "OK") case.
-                        print("It failed to properly understand and correctly respond to the following command:")
-            print("    " + command)
-            failed_kwpd3b0_setup_cmds = failed_kwpd3b0_setup_cmds + command + ','
-    if failed_kwpd3b0_setup_cmds != '':
-        print("You will need to buy or borrow an ELM327 device which can successfully")
-        print("perform the following commands:")
-        print("    ATZ")
-        for command in initcommands:
-            print("    " + command)
-        print("    B903")
-        print("    ATSH 82 51 13")
-        print("    A0")
-        print("    ATPC")
-        return False
-    return True
-
-def milageread():
-    data_error_str = False
-    elmreply = elmcommand('B903')
-    if elmreply.startswith("BUS INIT:"):
-        if ".OK" in elmreply:
-            # Normal case (when ATSP 3 used) is: "BUS INIT: ...OK".
-            pass
-        elif ".ERROR" in elmreply:
-            # The "BUS INIT: ...ERROR" response can occur:
-            # - when an ATSI or B903 is issued too soon after the ATZ,
-            #   yet the COMBI still considers that a previous (according to
-            #   ELM327) connection is still in effect,
-            # - when the ignition is off [the most common case], and
-            # - probably for other reasons.
-            # I've made a conscious decision to *not* wait 5.1 seconds
-            # between the ATZ and the first thing that initiates the
-            # KWPD3B0 connection -- previously it was ATSI, but now 
-            # (after removing use of the ATSI) it is the first B903 -- 
-            # to avoid that potentially unnecessary initial delay of
-            # 5.1 seconds (like mikeri avoided originally), since:
-            # a) most users will probably run milageread once,
-            #    soon after turning ignition to pos II, then will not run
-            #    milageread again before turning off ignition,
-            # but most importantly,
-            # b) because very, very likely, the other small change made
-            #    2016-01-09 -- the explicit termination of the connection
-            #    (on both ends, by both the COMBI and the ELM327), using:
-            #        ATSH 82 51 13
-            #        A0
-            #        ATPC
-            #    all coming *after* the mileage has been successfully read,
-            #    should essentially wipe out the 
-            #    "fail to connect on 2nd run of milageread" problem 
-            #    that existed in mikeri's original release.
-            # Consequently, a 5.1 second delay is deferred until now --
-            # when the "..." suggests there is at least enough continuity
-            # from the computer to the ELM327 to the car to at least try
-            # for 3 seconds to establish a connection, and the ERROR might be
-            # a recoverable situation.  The following ATPC / wait 5.1 sec / B903
-            # trio was the original way I recovered from the "failed on 2nd run"
-            # problem, *before* implementing the much more reliable
-            # "ATSH 82 51 13 / A0 then ATPC" solution.  The following
-            # "ATPC / wait 5.1 sec / B903" recovery mechanism can be disabled
-            # (if you are inconvenienced by it) by changing the value in the
-            # following line from True to False.
-            use_atpc_5_1_sec_delay_b903_retry = True
-            if use_atpc_5_1_sec_delay_b903_retry:
-                saved_elmreply = elmreply
-                elmreply = elmcommand("ATPC")
-                print("Waiting 5.1 seconds after B903's \"" + saved_elmreply + "\" and \"ATPC\"")
-                print("   to allow COMBI enough time to terminate its side of any previous connection,")
-                print("   or to allow you time to turn on ignition (if ignition off is the problem)...")
-                time.sleep(1.7)
-                print("   ........")
-                time.sleep(1.7)
-                print("   ........")
-                time.sleep(1.7)
-                print("   ........")
-                elmreply = elmcommand("B903")
-                # Repeat the ATPC / wait 5.1 sec / B903 trio only once, and only
-                # when there is an expectation it may succeed on that 2nd B903.
-                # Since we have just waited for 5.1 seconds, the B903 following
-                # the wait should establish a new COMBI (ECU 51) connection,
-                # since the ATSH 83 51 13 is still in effect.  Both the COMBI
-                # and the ELM327 should view it as a new connection.  If the
-                # "BUS INIT: ...ERROR" occurs once again, after the 2nd B903
-                # request, then it will be handled in the
-                # "if 'ERROR' in elmreply:" clause below.
-        elif "BUS ERROR" in elmreply:
-            # Little reason to retry when "BUS INIT: BUS ERROR" occurs, 
-            # since probably cable is unplugged, ignition is off, or some
-            # other fault has occurred which the software can not recover from.
+                        if ('?' in elmreply):
+                            self.out("It failed to understand the following command:")
+                        else:
+                            # This is a more accurate message for the "ATIIA 51" responding with "ELM327 v2.1" (instead of "OK") case.
+                            self.out("It failed to properly understand and correctly respond to the following command:")
+                self.out("    " + command)
+                failed_kwpd3b0_setup_cmds = failed_kwpd3b0_setup_cmds + command + ','
+        self.failed_commands = [c for c in failed_kwpd3b0_setup_cmds.split(',') if c]
+        if self.cache is not None:
+            failed = self.failed_commands
+            self.cache.put(self.cache_key, {'ok': not failed,
+                                            'failed': failed,
+                                            'version': elmcheck.strip(),
+                                            'commands': self.initcommands,
+                                            'configured': time.time()})
+        if failed_kwpd3b0_setup_cmds != '':
+            self.print_kwpd3b0_commands()
+            return False
+        if self.baud_upgrade: self.upgrade_baud(self.baud_upgrade)
+        return True
+
+    def print_kwpd3b0_commands(self):
+        self.out("You will need to buy or borrow an ELM327 device which can successfully")
+        self.out("perform the following commands:")
+        self.out("    ATZ")
+        for command in self.initcommands:
+            self.out("    " + command)
+        self.out("    B903")
+        self.out("    ATSH 82 51 13")
+        self.out("    A0")
+        self.out("    ATPC")
+
+    def command_failed(self, command, elmreply):
+        # Whether the reply to an init command shows a KWPD3B0-deficient
+        # adapter: not understood at all, or ATIIA answered with anything
+        # but OK.
+        return ('?' in elmreply) or ((command == 'ATIIA 51') and (elmreply != 'OK'))
+
+    def still_deficient(self, entry):
+        # A negative cache entry is only trusted while it is fresh, and if
+        # the first command it says failed still fails.  That one command
+        # is all it costs to tell a good adapter apart from a clone that
+        # identifies itself the same way.
+        if not self.cache.fresh(entry) or not entry['failed']:
+            return False
+        command = entry['failed'][0]
+        return self.command_failed(command, self.elmcommand(command))
+
+    def identify(self):
+        # Cache key for this adapter: port plus what the adapter says about
+        # itself.  ATI and AT@1 don't change any settings.
+        return '|'.join([self.port, self.elmcommand('ATI').strip(), self.elmcommand('AT@1').strip()])
+
+    def probe_configured(self):
+        # Cheap check that the adapter still has the settings init() gave it
+        # last time.  ATSP 3 is stored in the ELM327's memory, so ATDPN alone
+        # can't tell a power cycle apart; that case is caught when the read
+        # fails, and read() then does the full init and reads again.  milageread()
+        # leaves ATSH 82 51 13 behind, so the request header is always resent.
+        if self.elmcommand('ATDPN').strip() != '3':
+            return False
+        return self.elmcommand('ATSH 83 51 13') == 'OK'
+
+    def read_voltage(self):
+        # ATRV as a float, or None if the adapter didn't give a voltage.
+        reply = self.elmcommand('ATRV').strip().rstrip('Vv')
+        try:
+            return float(reply)
+        except ValueError:
+            return None
+
+    def wait_for_combi(self, delay):
+        # Wait up to delay seconds for the COMBI to be ready for a new
+        # connection.  The battery voltage seen by the ELM327 steps when the
+        # ignition or engine is switched on; after such a step only
+        # self.retry.settle more seconds are waited.  If the COMBI instead
+        # still holds a previous connection, the voltage doesn't change and
+        # the whole delay is used.
+        start = time.time()
+        end = start + delay
+        next_dots = start + 1.7
+        baseline = None
+        if self.retry.voltage_step > 0: baseline = self.read_voltage()
+        while True:
+            now = time.time()
+            if now >= end: break
+            time.sleep(min(self.retry.poll, end - now))
+            if time.time() >= next_dots:
+                self.out("   ........")
+                next_dots = next_dots + 1.7
+            if baseline is None: continue
+            voltage = self.read_voltage()
+            if voltage is not None and abs(voltage - baseline) >= self.retry.voltage_step:
+                self.out("   Voltage changed from {0:.1f}V to {1:.1f}V. Ignition switched on?".format(baseline, voltage))
+                end = min(end, time.time() + self.retry.settle)
+                baseline = None
+
+    def milageread(self, keep_session=False):
+        data_error_str = False
+        if self.need_header:
+            self.elmcommand('ATSH 83 51 13')
+            self.need_header = False
+        decoder = KwpDecoder(0xF9, 0x03)
+        elmreply = self.elmcommand('B903', decoder)
+        # Whether this read had to connect to the COMBI (5-baud BUS INIT)
+        # rather than using an open connection.
+        self.new_connection = elmreply.startswith("BUS INIT:")
+        if elmreply.startswith("BUS INIT:"):
+            if ".OK" in elmreply:
+                # Normal case (when ATSP 3 used) is: "BUS INIT: ...OK".
+                pass
+            elif ".ERROR" in elmreply and self.cached_init:
+                # Maybe the ELM327 lost its cached settings and is trying
+                # the wrong ECU.  read() re-initializes it, which is much
+                # quicker than waiting for the COMBI first.
+                pass
+            elif ".ERROR" in elmreply:
+                # The "BUS INIT: ...ERROR" response can occur:
+                # - when an ATSI or B903 is issued too soon after the ATZ,
+                #   yet the COMBI still considers that a previous (according to
+                #   ELM327) connection is still in effect,
+                # - when the ignition is off [the most common case], and
+                # - probably for other reasons.
+                # I've made a conscious decision to *not* wait 5.1 seconds
+                # between the ATZ and the first thing that initiates the
+                # KWPD3B0 connection -- previously it was ATSI, but now 
+                # (after removing use of the ATSI) it is the first B903 -- 
+                # to avoid that potentially unnecessary initial delay of
+                # 5.1 seconds (like mikeri avoided originally), since:
+                # a) most users will probably run milageread once,
+                #    soon after turning ignition to pos II, then will not run
+                #    milageread again before turning off ignition,
+                # but most importantly,
+                # b) because very, very likely, the other small change made
+                #    2016-01-09 -- the explicit termination of the connection
+                #    (on both ends, by both the COMBI and the ELM327), using:
+                #        ATSH 82 51 13
+                #        A0
+                #        ATPC
+                #    all coming *after* the mileage has been successfully read,
+                #    should essentially wipe out the 
+                #    "fail to connect on 2nd run of milageread" problem 
+                #    that existed in mikeri's original release.
+                # Consequently, a 5.1 second delay is deferred until now --
+                # when the "..." suggests there is at least enough continuity
+                # from the computer to the ELM327 to the car to at least try
+                # for 3 seconds to establish a connection, and the ERROR might be
+                # a recoverable situation.  The following ATPC / wait 5.1 sec / B903
+                # trio was the original way I recovered from the "failed on 2nd run"
+                # problem, *before* implementing the much more reliable
+                # "ATSH 82 51 13 / A0 then ATPC" solution.  How often and how
+                # long the "ATPC / wait / B903" recovery mechanism waits is set by
+                # self.retry (see RetryPolicy); --retry-attempts 1 disables it.
+                # While waiting, ATRV is polled so that switching the ignition on
+                # ends the wait early.
+                deadline = time.time() + self.retry.deadline
+                for delay in self.retry.delays():
+                    if time.time() >= deadline: break
+                    saved_elmreply = elmreply
+                    elmreply = self.elmcommand("ATPC")
+                    self.out("Waiting up to {0:.1f} seconds after B903's \"{1}\" and \"ATPC\"".format(delay, saved_elmreply))
+                    self.out("   to allow COMBI enough time to terminate its side of any previous connection,")
+                    self.out("   or to allow you time to turn on ignition (if ignition off is the problem)...")
+                    self.wait_for_combi(min(delay, deadline - time.time()))
+                    if self.metrics is not None: self.metrics.retry(self.port, 'B903')
+                    decoder = KwpDecoder(0xF9, 0x03)
+                    elmreply = self.elmcommand("B903", decoder)
+                    # Since we have just waited, the B903 following the wait
+                    # should establish a new COMBI (ECU 51) connection, since the
+                    # ATSH 83 51 13 is still in effect.  Both the COMBI and the
+                    # ELM327 should view it as a new connection.  If the
+                    # "BUS INIT: ...ERROR" occurs once again after the last
+                    # attempt, then it will be handled in the
+                    # "if 'ERROR' in elmreply:" clause below.
+                    if '...ERROR' not in elmreply: break
+            elif "BUS ERROR" in elmreply:
+                # Little reason to retry when "BUS INIT: BUS ERROR" occurs, 
+                # since probably cable is unplugged, ignition is off, or some
+                # other fault has occurred which the software can not recover from.
+                pass
+            else:
+                # There's no other cases that I can remember worthy of retry
+                # like the "BUS INIT: ...ERROR", so just fallthru to the error 
+                # checking.
+                pass
+        # The final B903 reply as received, for the ResultStore.
+        self.raw = elmreply.strip()
+        if 'ERROR' in elmreply:
+            if '...ERROR' in elmreply:
+                if self.retry.attempts > 1:
+                    self.out("...ERROR returned. Ignition is most probably off,")
+                    self.out("   or COMBI is being finicky about its connection timing.")
+                else:
+                    self.out("...ERROR returned. Does COMBI think previous connection is still in effect?")
+                    self.out("   Or is Ignition off?  Or did you not wait > 5 seconds?")
+                    self.out("   Or is the COMBI being finicky about its connection timing?")
+                    # self.out("   Retry milageread, then if \"...ERROR\" occurs again, ignition is probably off.")
+                self.out("   Ensure either: a) ignition is at pos II, or b) engine is on")
+                self.out("     (for at least 5 seconds).")
+                self.out("   Then retry milageread (at least once more).")
+                self.out("   If problem persists while engine is already on,")
+                self.out("     then turn off engine, wait a few seconds,")
+                self.out("     turn ignition to pos II, wait a few seconds,")
+                self.out("     then retry milageread (one or more times).")
+                return
+            elif 'BUS ERROR' in elmreply:
+                self.out("BUS ERROR returned. ELM327 not connected to car's OBDII port?")
+                self.out("   Or ELM327 not plugged in tight enough to car's OBDII port?")
+                self.out("   Bad fuse to OBDII port? Battery disconnected? Wiring error?")
+                self.out("   Usually when BUS ERROR occurs, ATRV shows 0.0V (ie, no power to ELM327).")
+                return
+            elif 'DATA ERROR' in elmreply:
+                # Ensure the final general purpose ERROR check is not triggered.
+                # If we have DATA ERROR, normally it is not a true data error,
+                #   but is: 
+                #   - an inappropriate concatenation of request and response(s)
+                #     on the same line, or
+                #   - one or more "7E B9 23" (temporarily delayed) response(s)
+                #     followed by the final response, all on one line.
+                # Hopefully, we handle these in later code without having to abort
+                #   unnecessarily in the 2nd following general purpose ERROR clause.
+                data_error_str = True
+            elif 'RX ERROR' in elmreply:
+                self.out("RX ERROR returned. Reception error. Possibly a baud rate error.")
+                self.out("   Retry milageread.")
+                return
+            elif 'ERROR' in elmreply:
+                self.out("ERROR returned. Car not connected? Ignition off? Bad fuse to OBDII port? Check the specific ELM327 error reason.")
+                return
+        # Only a complete F9 03 frame with a correct checksum is accepted,
+        # no matter how many "BUS INIT: ...OK" lines, "7E B9 23" responses or
+        # <DATA ERROR concatenations surround it.  This (like the '85 13 51
+        # F9 03' search it replaced) is what keeps the "falsely reporting
+        # mileage as 10170" problem solved.
+        if decoder.payload is None or len(decoder.payload) < 2:
+            if self.metrics is not None:
+                self.metrics.error(self.port, 'B903', 'checksum mismatch' if decoder.rejected else
+                                   'temporarily delayed' if decoder.pending else 'invalid response')
+            if decoder.rejected:
+                self.out("Corrupted response from COMBI (checksum mismatch): " + hexbytes(decoder.rejected[-1]))
+                self.out("   Please try again.")
+            else:
+                self.out("Invalid, unexpected, or missing response. Please try again.")
+            if decoder.pending:
+                # The ELM327 gave up on the COMBI while it was still busy.
+                self.out("   The ELM327 stopped waiting after a \"7E B9 23\" (temporarily delayed) response.")
+                self.out("   Use a longer --st or --adaptive-timing 0.")
+            return
+        milagebytes = decoder.payload
+        # For offline testing:
+        # milagebytes = bytearray([0x5d, 0x43])
+        if self.debug: self.out(hexbytes(decoder.frames[-1]))
+        hexvalue = '{0:02X}{1:02X}'.format(milagebytes[1], milagebytes[0])
+        if self.debug: self.out("B903 data: {0}".format(hexvalue))
+        miles, kilometers = decode_milage(milagebytes)
+        # Print mileage so it stands out no matter what switches are used.
+        milage_msg =  "---  Milage: {0} miles, {1} kilometers  ---".format(miles, kilometers)
+        border = "-" * len(milage_msg)
+        self.out(border)
+        self.out(milage_msg)
+        self.out(border)
+        #
+        if keep_session:
+            # Leave the KWPD3B0 connection up for the next B903 (see serve()).
+            # The ELM327 keeps it alive with the ATWM wakeup message.
+            self.kwp_open = True
+        else:
+            self.end_session()
+        return miles, kilometers
+
+    def end_session(self):
+        # The following statements are **the** main thing that eliminates the
+        # "fail to connect on 2nd run of milageread" problem that existed
+        # in mikeri's original release.
+        # - Comment all 3 of the lines containing "elmcommand" if you want to
+        #   regenerate that problem.
+        #
+        # Instruct COMBI (ECU 51), or whichever ECU read_batch() is talking
+        # to, to Stop Communication (A0) immediately.
+        self.elmcommand(kwp_header(self.ecu, b'\xa0'))
+        self.elmcommand('A0')
+        # Instruct ELM327 to terminate the protocol connection immediately.
+        self.elmcommand('ATPC')
+        self.kwp_open = False
+        # ATSH 82 51 13 is now in effect instead of the B903 request header.
+        self.need_header = True
+
+    def select_ecu(self, ecu):
+        # Make the next BUS INIT connect to ecu instead: its address for the
+        # 5-baud init, and the wakeup message that keeps the connection up.
+        self.elmcommand('ATIIA {0:02X}'.format(ecu))
+        self.elmcommand('ATWM {0} A1'.format(kwp_header(ecu, b'\xa1')[5:]))
+        self.ecu = ecu
+        self.need_header = True
+
+    def kwp_request(self, request):
+        # Send request to the current ECU (its header must be set) and
+        # decode the response.  A "BUS INIT: ...ERROR" is retried like
+        # milageread() does, but without the explanations.
+        command = hexbytes(request).replace(' ', '')
+        decoder = KwpDecoder(*kwp_response(request))
+        reply = self.elmcommand(command, decoder)
+        if '...ERROR' in reply:
+            deadline = time.time() + self.retry.deadline
+            for delay in self.retry.delays():
+                if time.time() >= deadline: break
+                self.elmcommand('ATPC')
+                self.wait_for_combi(min(delay, deadline - time.time()))
+                if self.metrics is not None: self.metrics.retry(self.port, command)
+                decoder = KwpDecoder(*kwp_response(request))
+                reply = self.elmcommand(command, decoder)
+                if '...ERROR' not in reply: break
+        result = {'ecu': '{0:02X}'.format(self.ecu), 'request': command, 'data': None, 'error': None}
+        if decoder.payload is not None:
+            result['data'] = hexbytes(decoder.payload)
+        elif decoder.negative is not None:
+            result['error'] = 'negative response {0:02X}'.format(decoder.negative)
+        elif decoder.rejected:
+            result['error'] = 'checksum mismatch'
+        elif decoder.pending:
+            result['error'] = 'temporarily delayed'
+        else:
+            errors = [line for line in reply.splitlines() if 'ERROR' in line or 'NO DATA' in line or 'STOPPED' in line]
+            result['error'] = errors[-1].strip() if errors else 'no response'
+        if decoder.frames:
+            # The ECU answered, so the connection is up.
+            self.kwp_open = True
+        return result
+
+    def read_batch(self, requests):
+        # Read many (ecu, request) pairs with as few BUS INITs and header
+        # switches as possible: requests are grouped by ECU, the ECU that
+        # is already connected (or set up) first, and within an ECU by
+        # length so that ATSH only changes when the length does.  Each ECU's
+        # connection is ended with A0 / ATPC before the next one's BUS INIT.
+        # An ECU that doesn't answer its BUS INIT (after the retries) is
+        # not tried again for its other requests; they get the same error.
+        # Returns one result dict per request, in the order given.
+        results = [None] * len(requests)
+        # The ATSH in effect is about to change.
+        self.need_header = True
+        groups = []
+        for index, (ecu, request) in enumerate(requests):
+            for group_ecu, indexes in groups:
+                if group_ecu == ecu:
+                    indexes.append(index)
+                    break
+            else:
+                groups.append((ecu, [index]))
+        groups.sort(key=lambda group: group[0] != self.ecu)
+        for ecu, indexes in groups:
+            if ecu != self.ecu:
+                if self.kwp_open: self.end_session()
+                self.select_ecu(ecu)
+            header = None
+            failed = None
+            for index in sorted(indexes, key=lambda i: len(requests[i][1])):
+                request = requests[index][1]
+                if failed is not None:
+                    results[index] = dict(failed, request=hexbytes(request).replace(' ', ''))
+                    continue
+                if header != kwp_header(ecu, request):
+                    header = kwp_header(ecu, request)
+                    self.elmcommand(header)
+                results[index] = self.kwp_request(request)
+                error = results[index]['error'] or ''
+                if not self.kwp_open and ('...ERROR' in error or 'BUS ERROR' in error):
+                    failed = results[index]
+            if self.kwp_open: self.end_session()
+        if self.ecu != 0x51:
+            # Leave the adapter set up for the COMBI, as init() did.
+            self.select_ecu(0x51)
+        for result in results:
+            self.out("ECU {0} {1}: {2}".format(result['ecu'], result['request'], result['data'] or result['error']))
+        return results
+
+class ReadServer(object):
+    # Serves mileage reads from one configured ElmSession to local clients,
+    # one read at a time.  The KWPD3B0 connection is kept open between reads,
+    # so only the first read pays for the BUS INIT.  If the adapter is lost,
+    # the port is opened and initialized again before the next read.
+    def __init__(self, session):
+        self.session = session
+        self.lock = threading.Lock()
+        self.lost = False
+
+    def reconnect(self):
+        # Raises NoAdapter or UnsupportedAdapter if that doesn't work (yet).
+        session = self.session
+        try:
+            session.ser.close()
+        except (IOError, OSError):
             pass
+        session.kwp_open = False
+        session.prompt_pending = False
+        del session.rxbuf[:]
+        if session.upgraded_from is not None:
+            # A replugged adapter is back at its original rate.
+            session.baud = str(session.upgraded_from)
+            session.upgraded_from = None
+        if not session.open():
+            raise NoAdapter("Failed to open port {0}.".format(session.port), session.messages)
+        if not session.init():
+            raise UnsupportedAdapter("ELM327 device can not do KWPD3B0.", session.messages)
+        self.lost = False
+
+    def read(self):
+        with self.lock:
+            session = self.session
+            start = time.time()
+            result = None
+            outcome = 'ok'
+            try:
+                if self.lost:
+                    self.reconnect()
+                result = session.read(keep_session=True)
+                if result is None:
+                    # Start over with a fresh connection next time.
+                    outcome = 'NoReading'
+                    session.end_session()
+            except ElmError as e:
+                # Lost the adapter (or what was plugged in instead isn't
+                # usable); the messages say why.  Don't use the port again
+                # until it has been reopened.
+                session.kwp_open = False
+                self.lost = True
+                outcome = type(e).__name__
+            session.result = result
+            session.record_read(time.time() - start, outcome)
+            reply = {'ok': result is not None,
+                     'seconds': time.time() - start,
+                     'session_reused': result is not None and not session.new_connection,
+                     'messages': session.messages}
+            if result is not None:
+                reply['miles'], reply['kilometers'] = result
+            # Don't let a long-running server accumulate messages.
+            session.messages = []
+            return reply
+
+def is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+def serve(session, address):
+    # Serve reads on a Unix socket (a path) or on TCP (host:port, where an
+    # empty host means localhost) until interrupted or terminated.
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+
+    class ReadRequestHandler(socketserver.StreamRequestHandler):
+        # One request per line.  "read" answers with one line of JSON.
+        def handle(self):
+            while True:
+                line = self.rfile.readline()
+                if not line: break
+                request = line.decode('ascii', 'replace').strip().lower()
+                if request == 'read':
+                    reply = self.server.reader.read()
+                elif request == '':
+                    continue
+                else:
+                    reply = {'ok': False, 'messages': ['Unknown request "{0}". Send "read".'.format(request)]}
+                self.wfile.write((json.dumps(reply) + '\n').encode('ascii'))
+
+    if ':' in address:
+        host, tcp_port = address.rsplit(':', 1)
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((host or '127.0.0.1', int(tcp_port)), ReadRequestHandler)
+    else:
+        if os.path.exists(address):
+            if not is_socket(address):
+                session.out("{0} exists and is not a socket. Not serving on it.".format(address))
+                return
+            # Left behind by a server that was killed.
+            os.unlink(address)
+        server = socketserver.ThreadingUnixStreamServer(address, ReadRequestHandler)
+    server.daemon_threads = True
+    server.reader = ReadServer(session)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    session.out("Serving mileage reads on " + address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if ':' not in address and is_socket(address): os.unlink(address)
+        with server.reader.lock:
+            if session.kwp_open: session.end_session()
+
+def poll(session, interval, count):
+    # Read B903 every interval seconds over one KWPD3B0 connection, count
+    # times (0 = until Ctrl-C).  Only the first read pays for the BUS INIT;
+    # the connection is ended with A0 / ATPC when polling stops.
+    latencies = []
+    n = 0
+    try:
+        while count == 0 or n < count:
+            start = time.time()
+            result = session.read(keep_session=True)
+            elapsed = time.time() - start
+            reused = not session.new_connection
+            n = n + 1
+            if result is None:
+                session.end_session()
+            elif reused:
+                latencies.append(elapsed)
+            session.result = result
+            session.record_read(elapsed, 'ok' if result is not None else 'NoReading')
+            session.out("Read {0}: {1:.0f} ms{2}".format(n, elapsed * 1000, '' if reused else ' (new connection)'))
+            # Already printed; don't let a long poll accumulate them.
+            session.messages = []
+            if count == 0 or n < count:
+                time.sleep(max(0, start + interval - time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if session.kwp_open: session.end_session()
+    if latencies:
+        latencies.sort()
+        session.out("Latency of {0} reads over the open connection: min {1:.0f} ms, median {2:.0f} ms, max {3:.0f} ms".format(
+                    len(latencies), latencies[0] * 1000, latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+    return latencies
+
+def expand_ports(patterns):
+    # Expand globs like /dev/ttyUSB* ourselves so they also work on Windows
+    # shells, and so the same port is never read twice.
+    ports = []
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            matches = sorted(glob.glob(pattern))
         else:
-            # There's no other cases that I can remember worthy of retry
-            # like the "BUS INIT: ...ERROR", so just fallthru to the error 
-            # checking.
+            matches = [pattern]
+        for port in matches:
+            if port not in ports: ports.append(port)
+    return ports
+
+# Where USB, CDC-ACM and Bluetooth (rfcomm) adapters show up on Linux.
+# Elsewhere pyserial's list of ports is used as well.
+discovery_patterns = ['/dev/ttyUSB*', '/dev/ttyACM*', '/dev/rfcomm*']
+
+def candidate_ports(patterns=None):
+    # The ports to probe for adapters: those matching patterns, or by
+    # default every USB / ACM / rfcomm device plus what pyserial lists.
+    ports = expand_ports(patterns or discovery_patterns)
+    if not patterns:
+        try:
+            from serial.tools import list_ports
+            for info in list_ports.comports():
+                if info.device not in ports: ports.append(info.device)
+        except ImportError:
             pass
-    if 'ERROR' in elmreply:
-        if '...ERROR' in elmreply:
-            if use_atpc_5_1_sec_delay_b903_retry:
-                print("...ERROR returned. Ignition is most probably off,")
-                print("   or COMBI is being finicky about its connection timing.")
-            else:
-                print("...ERROR returned. Does COMBI think previous connection is still in effect?")
-                print("   Or is Ignition off?  Or did you not wait > 5 seconds?")
-                print("   Or is the COMBI being finicky about its connection timing?")
-                # print("   Retry milageread, then if \"...ERROR\" occurs again, ignition is probably off.")
-            print("   Ensure either: a) ignition is at pos II, or b) engine is on")
-            print("     (for at least 5 seconds).")
-            print("   Then retry milageread (at least once more).")
-            print("   If problem persists while engine is already on,")
-            print("     then turn off engine, wait a few seconds,")
-            print("     turn ignition to pos II, wait a few seconds,")
-            print("     then retry milageread (one or more times).")
-            return
-        elif 'BUS ERROR' in elmreply:
-            print("BUS ERROR returned. ELM327 not connected to car's OBDII port?")
-            print("   Or ELM327 not plugged in tight enough to car's OBDII port?")
-            print("   Bad fuse to OBDII port? Battery disconnected? Wiring error?")
-            print("   Usually when BUS ERROR occurs, ATRV shows 0.0V (ie, no power to ELM327).")
-            return
-        elif 'DATA ERROR' in elmreply:
-            # Ensure the final general purpose ERROR check is not triggered.
-            # If we have DATA ERROR, normally it is not a true data error,
-            #   but is: 
-            #   - an inappropriate concatenation of request and response(s)
-            #     on the same line, or
-            #   - one or more "7E B9 23" (temporarily delayed) response(s)
-            #     followed by the final response, all on one line.
-            # Hopefully, we handle these in later code without having to abort
-            #   unnecessarily in the 2nd following general purpose ERROR clause.
-            data_error_str = True
-        elif 'RX ERROR' in elmreply:
-            print("RX ERROR returned. Reception error. Possibly a baud rate error.")
-            print("   Retry milageread.")
-            return
-        elif 'ERROR' in elmreply:
-            print("ERROR returned. Car not connected? Ignition off? Bad fuse to OBDII port? Check the specific ELM327 error reason.")
-            return
-    # The next few statements involving ipos are what solved the
-    # "falsely reporting mileage as 10170" problem.
-    ipos = elmreply.upper().find('85 13 51 F9 03')
-    if ipos == -1:
-        print("Invalid, unexpected, or missing response. Please try again.")
+    return ports
+
+def discover_port(port, rates=(38400, 115200), timeout=0.3):
+    # Look for an ELM327 on port with a short ATI (waiting timeout seconds)
+    # at each rate, and if one answers, read its voltage and run init()'s KWPD3B0 capability check.
+    session = ElmSession(port, 'auto', echo=False)
+    session.baud_candidates = list(rates)
+    found = {'port': port, 'baud': None, 'version': None, 'voltage': None,
+             'kwpd3b0': None, 'failed': []}
+    try:
+        if not session.open(timeout):
+            return found
+        try:
+            found['baud'] = int(session.baud)
+            found['version'] = session.elmcommand('ATI').strip()
+            found['voltage'] = session.read_voltage()
+            found['kwpd3b0'] = session.init()
+            found['failed'] = session.failed_commands
+            if session.version: found['version'] = session.version
+        finally:
+            session.close()
+    except ElmError:
+        # Answered at first, then stopped; or no ELM327 after all.
+        pass
+    return found
+
+def discover(patterns, jobs):
+    # Probe all candidate ports concurrently, so discovery takes about as
+    # long as the slowest port instead of the sum of all of them.
+    ports = candidate_ports(patterns)
+    if not ports:
+        print("No serial ports found.")
+        return []
+    found = [None] * len(ports)
+    slots = threading.BoundedSemaphore(jobs)
+
+    def worker(index, port):
+        with slots:
+            found[index] = discover_port(port)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(i, port)) for i, port in enumerate(ports)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    print("Probed {0} ports in {1:.1f} seconds:".format(len(ports), time.time() - start))
+    for adapter in found:
+        if adapter['baud'] is None:
+            print("   {0}: no ELM327".format(adapter['port']))
+            continue
+        voltage = '' if adapter['voltage'] is None else ', {0:.1f}V'.format(adapter['voltage'])
+        if adapter['kwpd3b0']:
+            capability = 'can read the mileage'
+        elif adapter['failed']:
+            capability = 'not KWPD3B0 capable (fails ' + ', '.join(adapter['failed']) + ')'
+        else:
+            capability = 'not KWPD3B0 capable'
+        print("   {0}: {1} at {2} baud{3}, {4}".format(adapter['port'], adapter['version'] or 'ELM327',
+                                                      adapter['baud'], voltage, capability))
+    return found
+
+def fleet_capture_path(path, port):
+    # capture.txt + /dev/ttyUSB0 -> capture.ttyUSB0.txt
+    if not path:
+        return None
+    root, ext = os.path.splitext(path)
+    name = ''.join(c if c.isalnum() else '_' for c in os.path.basename(port))
+    return '{0}.{1}{2}'.format(root, name, ext)
+
+def run_fleet(ports, args):
+    # Read every port concurrently, at most args.jobs at a time.  Each port's
+    # messages are printed as one block when that port is done, followed by
+    # a summary of all ports at the end.
+    cache = make_cache(args)
+    sessions = [make_session(port, args, echo=False, cache=cache, capture_path=fleet_capture_path(args.capture, port))
+                for port in ports]
+    slots = threading.BoundedSemaphore(args.jobs)
+    print_lock = threading.Lock()
+
+    def worker(session):
+        with slots:
+            try:
+                session.run()
+            except ElmError:
+                # Session gave up (no ELM327, wrong baud rate, lost port,
+                # no reading); its messages already say why.
+                pass
+            except Exception as e:
+                session.out("Unexpected error: {0}".format(e))
+        with print_lock:
+            print("=== {0} ===".format(session.port))
+            for msg in session.messages: print(msg)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(session,)) for session in sessions]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    print("Fleet summary: {0} ports in {1:.1f} seconds".format(len(sessions), time.time() - start))
+    for session in sessions:
+        if session.result:
+            print("   {0}: {1} miles, {2} kilometers".format(session.port, session.result[0], session.result[1]))
+        else:
+            print("   {0}: no reading".format(session.port))
+    return sessions
+
+def make_session(port, args, echo=True, cache=None, capture_path=None):
+    if cache is None: cache = make_cache(args)
+    if capture_path is None: capture_path = args.capture
+    capture = CaptureWriter(capture_path, port, args.baud) if capture_path else None
+    return ElmSession(port, args.baud, args.debug, args.dump, echo=echo, cache=cache, capture=capture,
+                      retry=make_retry(args), keepalive=args.keepalive, baud_upgrade=args.baud_upgrade,
+                      timeouts=args.timeouts, adaptive_timing=args.adaptive_timing, st=args.st,
+                      requests=args.requests, metrics=args.metrics, store=args.store,
+                      vehicle=args.vehicles.get(port))
+
+def parse_timeouts(parser, specs):
+    timeouts = {}
+    for spec in specs:
+        command, _, seconds = spec.partition('=')
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            parser.error("--timeout wants CMD=SECONDS, not " + spec)
+        command = command.strip().upper()
+        timeouts['' if command == 'KWP' else command] = seconds
+    return timeouts
+
+def parse_requests(parser, specs):
+    requests = []
+    for spec in specs:
+        try:
+            requests.append(parse_request(spec))
+        except ValueError:
+            parser.error("--request wants ECU:HEX, eg 51:B901, not " + spec)
+    return requests
+
+def make_metrics(args):
+    if not args.metrics_jsonl and not args.metrics_prom:
+        return None
+    return Metrics(args.metrics_jsonl, args.metrics_prom)
+
+def parse_vehicles(parser, specs, ports):
+    # --vehicle LABEL for a single port, or --vehicle PORT=LABEL per port, so
+    # that different cars are never stored under one label.
+    vehicles = {}
+    for spec in specs:
+        port, _, label = spec.rpartition('=')
+        if not port:
+            if len(ports) != 1:
+                parser.error("with several ports, label each one: --vehicle PORT=LABEL")
+            port = ports[0]
+        elif port not in ports:
+            parser.error("--vehicle {0}: {1} is not one of the ports read".format(spec, port))
+        if port in vehicles or not label:
+            parser.error("--vehicle wants one LABEL or PORT=LABEL per port, not " + spec)
+        vehicles[port] = label
+    return vehicles
+
+def make_store(args):
+    if args.store is None:
+        return None
+    return ResultStore(args.store)
+
+def print_history(store, vehicle):
+    for reading in store.history(vehicle, errors=True):
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reading['time']))
+        if reading['miles'] is not None:
+            result = "{0} miles, {1} kilometers".format(reading['miles'], reading['kilometers'])
+        else:
+            result = "no reading ({0})".format(reading['error'])
+        print("{0}  {1}  {2}: {3}".format(when, reading['vehicle'] or reading['port'], reading['adapter'], result))
+
+def print_anomalies(store, vehicle):
+    found = 0
+    for anomaly in store.anomalies(vehicle):
+        found = found + 1
+        before, after = anomaly['before'], anomaly['after']
+        print("{0}: {1} from {2} to {3} miles between {4} and {5}".format(
+              anomaly['vehicle'], anomaly['kind'], before['miles'], after['miles'],
+              time.strftime('%Y-%m-%d %H:%M', time.localtime(before['time'])),
+              time.strftime('%Y-%m-%d %H:%M', time.localtime(after['time']))))
+    print("{0} anomalies found.".format(found))
+
+def make_cache(args):
+    if args.cache is None:
+        return None
+    return AdapterCache(args.cache, args.cache_ttl)
+
+def make_retry(args):
+    return RetryPolicy(attempts=args.retry_attempts, delay=args.retry_delay,
+                       backoff=args.retry_backoff, max_delay=args.retry_max_delay,
+                       deadline=args.retry_deadline, voltage_step=args.retry_voltage_step)
+
+def read_mileage(port, baud='38400', **options):
+    # Read the mileage from the ELM327 on port, without printing anything.
+    # options are ElmSession's (cache, retry, timeouts, requests...).  Returns
+    # a dict with port, adapter (its ATZ identification), miles, kilometers,
+    # seconds, batch (read_batch()'s results for requests, if any) and
+    # messages; raises NoAdapter, UnsupportedAdapter or NoReading.
+    options.setdefault('echo', False)
+    session = ElmSession(port, baud, **options)
+    start = time.time()
+    miles, kilometers = session.run()
+    return {'port': port,
+            'adapter': session.version,
+            'miles': miles,
+            'kilometers': kilometers,
+            'seconds': time.time() - start,
+            'batch': session.batch,
+            'messages': session.messages}
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Read milage from old Volvos using an ELM327 interface connected to the OBDII port.")
+    parser.add_argument('port', metavar='P', nargs='*',
+                      help="What port to connect to. In Windows this is usually a COM-port, and in Linux /dev/ttyUSBx or /dev/ttySx where x is the port number. "
+                           "Several ports or a glob like '/dev/ttyUSB*' read all those adapters concurrently (fleet mode).")
+    parser.add_argument('--discover',
+                      action='store_true',
+                      help="Find ELM327 adapters: probe the given ports, or all USB, ACM and rfcomm serial ports, "
+                           "at 38400 and 115200 baud, and check that they can do KWPD3B0.")
+    parser.add_argument('--debug', 
+                      action='store_true',
+                      help="Print debug info.")
+    parser.add_argument('--dump', 
+                      action='store_true',
+                      help="Dump what milageread receives from ELM327, as it arrives.")
+    parser.add_argument('--capture',
+                      help="Stream everything sent to and received from the ELM327, with timestamps, to this file "
+                           "(in fleet mode one file per port, named after the port).",
+                      metavar='FILE')
+    parser.add_argument('-b', '--baud',
+                      nargs='?',
+                      const='38400',
+                      default='38400',
+                      choices=['auto', '9600', '38400', '57600', '115200', '230400', '500000'],
+                      help="Baud rate between computer and ELM327 (default 38400), or 'auto' to find it "
+                           "by probing each of these rates with a short timeout.",
+                      metavar='B')
+    parser.add_argument('--baud-upgrade',
+                      type=int,
+                      help="After init, raise the link to this baud rate with ATBRD if the ELM327 and the serial port "
+                           "accept it (eg 230400 or 500000). The original rate is restored before exit.",
+                      metavar='B')
+    parser.add_argument('--timeout',
+                      action='append',
+                      default=[],
+                      help="Seconds to wait for data after command(s) starting with CMD, eg ATZ=3, AT=0.5 or B903=6 "
+                           "(may be repeated; KWP=S sets the default for requests to the COMBI).",
+                      metavar='CMD=S')
+    parser.add_argument('--metrics',
+                      dest='metrics_jsonl',
+                      help="Append timings, byte counts, retries and errors of every command, phase and read "
+                           "to this file as JSON lines.",
+                      metavar='FILE')
+    parser.add_argument('--metrics-prom',
+                      help="Keep this file updated with totals of the same, in Prometheus text format "
+                           "(eg for node_exporter's textfile collector).",
+                      metavar='FILE')
+    parser.add_argument('--store',
+                      help="Record every read (time, port, adapter, raw B903 reply, miles, km or error) "
+                           "in this SQLite database.",
+                      metavar='FILE')
+    parser.add_argument('--vehicle',
+                      action='append',
+                      default=[],
+                      help="Label the reads in --store with this vehicle (eg its VIN or registration); "
+                           "with several ports, PORT=LABEL for each (may be repeated). "
+                           "With --history / --anomalies, only show this vehicle.",
+                      metavar='LABEL')
+    parser.add_argument('--history',
+                      action='store_true',
+                      help="Print the reads in --store (of --vehicle only, if given) instead of reading.")
+    parser.add_argument('--anomalies',
+                      action='store_true',
+                      help="Print odometer rollbacks and implausible jumps between reads in --store "
+                           "(of --vehicle only, if given) instead of reading.")
+    parser.add_argument('--request',
+                      action='append',
+                      default=[],
+                      help="After the mileage, also send this KWP request to this ECU, eg 51:B901 "
+                           "(may be repeated; requests are grouped by ECU so each ECU needs only one BUS INIT).",
+                      metavar='ECU:HEX')
+    parser.add_argument('--adaptive-timing',
+                      type=int,
+                      choices=[0, 1, 2],
+                      help="Add ATAT0/1/2 to the init commands: how aggressively the ELM327 shortens its wait "
+                           "after the last frame of a reply.",
+                      metavar='N')
+    parser.add_argument('--st',
+                      type=float,
+                      help="Add ATST to the init commands: the longest the ELM327 waits for another frame, "
+                           "in milliseconds (ELM327 default about 200).",
+                      metavar='MS')
+    parser.add_argument('-j', '--jobs',
+                      type=int,
+                      default=8,
+                      help="Fleet mode: maximum number of adapters read at the same time (default 8).",
+                      metavar='N')
+    parser.add_argument('--cache',
+                      nargs='?',
+                      const=os.path.join(os.path.expanduser('~'), '.milageread_cache.json'),
+                      help="Remember each adapter's configuration and capability check in this file "
+                           "(default ~/.milageread_cache.json), so repeat reads skip the ATZ reset and init commands "
+                           "and a deficient ELM327 is rejected at once.",
+                      metavar='FILE')
+    parser.add_argument('--cache-ttl',
+                      type=float,
+                      default=600,
+                      help="Seconds a cached adapter configuration is trusted (default 600).",
+                      metavar='S')
+    parser.add_argument('--retry-attempts',
+                      type=int,
+                      default=2,
+                      help="B903 attempts when \"BUS INIT: ...ERROR\" occurs, including the first (default 2; 1 disables retrying).",
+                      metavar='N')
+    parser.add_argument('--retry-delay',
+                      type=float,
+                      default=5.1,
+                      help="Seconds to wait before the first retry (default 5.1).",
+                      metavar='S')
+    parser.add_argument('--retry-backoff',
+                      type=float,
+                      default=1.0,
+                      help="Multiply the wait by this for every further retry (default 1.0).",
+                      metavar='F')
+    parser.add_argument('--retry-max-delay',
+                      type=float,
+                      default=10.0,
+                      help="Longest wait between retries (default 10).",
+                      metavar='S')
+    parser.add_argument('--retry-deadline',
+                      type=float,
+                      default=30.0,
+                      help="Give up retrying this many seconds after the first \"...ERROR\" (default 30).",
+                      metavar='S')
+    parser.add_argument('--retry-voltage-step',
+                      type=float,
+                      default=0.4,
+                      help="ATRV change in volts taken as ignition on, ending the wait early (default 0.4; 0 disables polling).",
+                      metavar='V')
+    parser.add_argument('--poll',
+                      type=float,
+                      help="Keep the connection to the COMBI open and read again every S seconds, "
+                           "printing the latency of each read.",
+                      metavar='S')
+    parser.add_argument('--count',
+                      type=int,
+                      default=0,
+                      help="With --poll: stop after N reads (default 0: until Ctrl-C).",
+                      metavar='N')
+    parser.add_argument('--keepalive',
+                      type=int,
+                      help="Have the ELM327 send its wakeup (keepalive) message to the COMBI every MS milliseconds "
+                           "while a connection is open (ATSW; ELM327 default is about 3000).",
+                      metavar='MS')
+    parser.add_argument('--serve',
+                      help="Keep the adapter open and serve reads: send \"read\" on a line to this Unix socket path, "
+                           "or to host:port on TCP, and get the result back as a line of JSON.",
+                      metavar='ADDRESS')
+    parser.add_argument('-v', '--version',
+                      action='version',
+                      version='milageread (w/ jonesrh enhancements thru 2017-09-23)')
+    args = parser.parse_args()
+    args.timeouts = parse_timeouts(parser, args.timeout)
+    args.requests = parse_requests(parser, args.request)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if args.discover:
+        discover(args.port, args.jobs)
+        return
+    if args.history or args.anomalies:
+        if not args.store:
+            parser.error("--history and --anomalies need --store")
+        if len(args.vehicle) > 1:
+            parser.error("--history and --anomalies take one --vehicle")
+        vehicle = args.vehicle[0] if args.vehicle else None
+        store = ResultStore(args.store)
+        try:
+            if args.history: print_history(store, vehicle)
+            if args.anomalies: print_anomalies(store, vehicle)
+        finally:
+            store.close()
         return
-    # Only keep what comes after any "BUS INIT: ...OK" response
-    # and/or any "7E B9 23" responses.
-    elmreply = elmreply[ipos:]
-    milagebytes = elmreply.split(' ')
-    # For offline testing:
-    # milagebytes = '85 13 51 f9 03 5d 43 85'.split(' ')
-    if debug: print(milagebytes)
-    hexvalue = milagebytes[6] + milagebytes[5]
-    if debug: print ("B903 data: {0}".format(hexvalue))
-    miles = int(hexvalue, 16) * 10
-    kilometers = int(miles * 1.609344)
-    # Print mileage so it stands out no matter what switches are used.
-    milage_msg =  "---  Milage: {0} miles, {1} kilometers  ---".format(miles, kilometers)
-    border = "-" * len(milage_msg)
-    print(border)
-    print(milage_msg)
-    print(border)
-    #
-    # The following statements are **the** main thing that eliminates the
-    # "fail to connect on 2nd run of milageread" problem that existed
-    # in mikeri's original release.
-    # - Comment all 3 of the lines containing "elmcommand" if you want to
-    #   regenerate that problem.
-    #
-    # Instruct COMBI (ECU 51) to Stop Communication (A0) immediately.
-    elmreply = elmcommand('ATSH 82 51 13')
-    elmreply = elmcommand('A0')
-    # Instruct ELM327 to terminate the protocol connection immediately.
-    elmreply = elmcommand('ATPC')
-    
-def rcvd_from_elm_dump():
-    # Lazy man's dump all chars with CR and LF expansion to:
-    # - determine how to handle CR and LF for different platforms, and
-    # - just to see exactly what ELM327 is sending when ATL0 / ATE1 is used
-    #   (and when other ATLx / ATEx variations are used).
-    # However, for some reason this does not catch the echo due to ATE1 ?!?!
-    s = repr(all_chars)
-    s = s.lstrip("bytearray(b'")
-    s = s.rstrip("')")
-    print ("All chars received: {0}".format(s))
-
-print ("Attempting communication...")
-try:
-    ser = serial.Serial(port, baud, timeout=5)
-except:
-    print("Failed to open port " + port + " at " + baud + " baud. ELM327 not connected? Wrong port #?")
-    sys.exit()
-
-if init():
-    milageread()
-if dump: rcvd_from_elm_dump()
-ser.close()
+    if not args.port:
+        parser.error("a port is required (or --discover)")
+    ports = expand_ports(args.port)
+    if not ports:
+        print("No ports match " + ' '.join(args.port) + ". ELM327 not connected?")
+        sys.exit()
+    if args.retry_attempts < 1:
+        parser.error("--retry-attempts must be at least 1")
+    if (args.serve or args.poll is not None) and len(ports) != 1:
+        parser.error("--serve and --poll take exactly one port")
+    if args.serve and ':' not in args.serve and os.path.exists(args.serve) and not is_socket(args.serve):
+        parser.error("--serve {0}: exists and is not a socket".format(args.serve))
+    args.vehicles = parse_vehicles(parser, args.vehicle, ports)
+    args.metrics = make_metrics(args)
+    args.store = make_store(args)
+    try:
+        if args.serve or args.poll is not None:
+            session = make_session(ports[0], args)
+            if not session.open():
+                sys.exit()
+            try:
+                if session.init():
+                    if args.serve:
+                        serve(session, args.serve)
+                    else:
+                        poll(session, args.poll, args.count)
+            finally:
+                session.close()
+        elif len(ports) == 1:
+            make_session(ports[0], args).run()
+        else:
+            run_fleet(ports, args)
+    except ElmError:
+        # The session has already printed why.
+        sys.exit()
+    finally:
+        if args.metrics is not None: args.metrics.close()
+        if args.store is not None: args.store.close()
 
+if __name__ == '__main__':
+    main()
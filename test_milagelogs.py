@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#
+# Behaviour tests for milagelogs' scanner, on a log mixing the formats it
+# understands.  Run with ./test_milagelogs.py or python -m pytest.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import milagelogs
+
+LOG = (b"ATZ: ELM327 v1.5\n"
+       b"B903: BUS INIT: ...OK\n"
+       b"84 13 51 7E B9 23 42\n"
+       b"85 13 51 F9 03 5D 43 85\n"
+       b"ATRV: 12.3V\n"
+       b"B903: [85 13 51 F9 03 5D 47 85]\n"
+       b"B903: [85 13 51 F9 03 5D 43 85]\n")
+
+class ScanTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'obdwiz.txt')
+        with open(self.path, 'wb') as f:
+            f.write(LOG)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scan(self, *bounds):
+        records = []
+        for start, end in zip(bounds, bounds[1:]):
+            records.extend(milagelogs.scan((self.path, start, end)))
+        return [(record['offset'], record['miles'], record['error']) for record in records]
+
+    def test_whole_file(self):
+        first, second, third = [LOG.index(b'B903'), LOG.index(b'B903: ['), LOG.rindex(b'B903')]
+        self.assertEqual(self.scan(0, len(LOG)), [(first, 172450, ''),
+                                                  (second, None, 'checksum mismatch'),
+                                                  (third, 172450, '')])
+
+    def test_chunk_split_inside_exchange(self):
+        # Split in the middle of the F9 03 frame of the first exchange: it
+        # is still read whole by the chunk it starts in, and only once.
+        split = LOG.index(b'5D 43 85')
+        self.assertEqual(self.scan(0, split, len(LOG)), self.scan(0, len(LOG)))
+
+    def test_every_split(self):
+        whole = self.scan(0, len(LOG))
+        for split in range(1, len(LOG)):
+            self.assertEqual(self.scan(0, split, len(LOG)), whole, split)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+#
+# Behaviour tests for the frame decoding, on replies seen from real cars,
+# and for whole sessions against elm327emu.  Run with ./test_milageread.py
+# or python -m pytest.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import milageread
+from milageread import KwpDecoder, decode_milage
+
+try:
+    import elm327emu
+except ImportError:
+    # No pseudo-terminals (Windows).
+    elm327emu = None
+
+class KwpDecoderTest(unittest.TestCase):
+    def decode(self, reply):
+        decoder = KwpDecoder(0xF9, 0x03)
+        decoder.feed(reply + '\r')
+        return decoder
+
+    def test_bus_init_then_pending_then_response(self):
+        # Test #1 -- multiline "BUS INIT: ...OK", then "7E B9 23", then "F9 03".
+        decoder = self.decode("BUS INIT: ...OK\r84 13 51 7e b9 23 42\r85 13 51 f9 03 5d 43 85")
+        self.assertFalse(decoder.pending)
+        self.assertEqual(decoder.rejected, [])
+        self.assertEqual(decode_milage(decoder.payload), (172450, 277531))
+
+    def test_concatenated_frames_and_data_error(self):
+        # Test #2 -- "7E B9 23" and "F9 03" on one line, then "<DATA ERROR".
+        decoder = self.decode("84 13 51 7e b9 23 42 85 13 51 f9 03 5d 43 85 <DATA ERROR")
+        self.assertEqual(len(decoder.frames), 2)
+        self.assertEqual(decode_milage(decoder.payload), (172450, 277531))
+
+    def test_bus_init_error(self):
+        # Test #3 -- "BUS INIT: ...ERROR", nothing from the COMBI.
+        decoder = self.decode("BUS INIT: ...ERROR")
+        self.assertFalse(decoder.done)
+        self.assertEqual(decoder.frames, [])
+        self.assertIsNone(decoder.negative)
+
+    def test_pending_only(self):
+        decoder = self.decode("84 13 51 7E B9 23 42")
+        self.assertTrue(decoder.pending)
+        self.assertFalse(decoder.done)
+
+    def test_corrupted_frame(self):
+        # One bit flipped in the mileage: the checksum no longer matches.
+        decoder = self.decode("85 13 51 F9 03 5D 47 85")
+        self.assertFalse(decoder.done)
+        self.assertEqual(decoder.rejected, [bytearray.fromhex('8513 51F9 035D 4785')])
+
+    def test_truncated_frame(self):
+        decoder = self.decode("85 13 51 F9 03 5D <DATA ERROR")
+        self.assertFalse(decoder.done)
+        self.assertEqual(decoder.rejected, [])
+
+    def test_truncated_frame_then_good_frame(self):
+        # The truncated frame must not take bytes from the next line.
+        decoder = self.decode("85 13 51 F9 03 5D\r85 13 51 F9 03 5D 43 85")
+        self.assertEqual(decoder.rejected, [])
+        self.assertEqual(decode_milage(decoder.payload), (172450, 277531))
+
+    def test_truncated_frame_fed_in_chunks(self):
+        # As read_until_prompt() feeds it: chunks don't end at lines.
+        decoder = KwpDecoder(0xF9, 0x03)
+        for chunk in ["85 13 5", "1 F9 03 5D\r85 1", "3 51 F9 03 5D 43", " 85\r"]:
+            decoder.feed(chunk)
+        self.assertEqual(decode_milage(decoder.payload), (172450, 277531))
+
+@unittest.skipIf(elm327emu is None, "elm327emu needs a POSIX pseudo-terminal")
+class EmulatorTest(unittest.TestCase):
+    # Whole sessions against elm327emu, with the BUS INIT delay and the
+    # retry waits shortened so that a test takes a fraction of a second
+    # unless it waits where it shouldn't.
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.emu = elm327emu.Elm327Emulator(bus_init_delay=0.0)
+        self.port = self.emu.start()
+
+    def tearDown(self):
+        self.emu.stop()
+        shutil.rmtree(self.dir)
+
+    def session(self, **options):
+        options.setdefault('retry', milageread.RetryPolicy(delay=0.2, poll=0.05))
+        return milageread.ElmSession(self.port, echo=False, **options)
+
+    def sent(self, command):
+        return self.emu.commands.count(command)
+
+    def power_cycle(self):
+        # Back to power-on settings, except ATSP 3, which the ELM327 keeps
+        # in memory, so probe_configured() can't tell.
+        self.emu.reset()
+        self.emu.protocol = 3
+        del self.emu.commands[:]
+
+class CacheTest(EmulatorTest):
+    def setUp(self):
+        EmulatorTest.setUp(self)
+        self.cache = milageread.AdapterCache(os.path.join(self.dir, 'cache.json'))
+        self.assertEqual(self.session(cache=self.cache).run(), (172450, 277531))
+
+    def test_cached_configuration_skips_reset(self):
+        del self.emu.commands[:]
+        session = self.session(cache=self.cache)
+        self.assertEqual(session.run(), (172450, 277531))
+        self.assertEqual(self.sent('ATZ'), 0)
+
+    def test_power_cycle_falls_back_to_full_init(self):
+        self.power_cycle()
+        start = time.time()
+        self.assertEqual(self.session(cache=self.cache).run(), (172450, 277531))
+        # No ATPC / wait / B903 retries with the stale settings first.
+        self.assertEqual(self.sent('ATZ'), 1)
+        self.assertEqual(self.sent('B903'), 2)
+        self.assertEqual(self.sent('ATPC'), 1)
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_server_recovers_from_power_cycle(self):
+        self.power_cycle()
+        session = self.session(cache=self.cache)
+        self.assertTrue(session.open())
+        try:
+            self.assertTrue(session.init())
+            self.assertTrue(session.cached_init)
+            reader = milageread.ReadServer(session)
+            reply = reader.read()
+            self.assertTrue(reply['ok'], reply['messages'])
+            self.assertEqual(reply['miles'], 172450)
+            self.assertTrue(reader.read()['session_reused'])
+        finally:
+            session.close()
+
+class RetryTest(EmulatorTest):
+    def test_retry_after_bus_init_error(self):
+        self.emu.bus_init_errors = 1
+        start = time.time()
+        session = self.session(retry=milageread.RetryPolicy(delay=0.3, poll=0.05, voltage_step=0))
+        self.assertEqual(session.run(), (172450, 277531))
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertEqual(self.sent('B903'), 2)
+        self.assertEqual(self.emu.commands.index('ATPC'), self.emu.commands.index('B903') + 1)
+
+    def test_no_retry_with_one_attempt(self):
+        self.emu.bus_init_errors = 1
+        session = self.session(retry=milageread.RetryPolicy(attempts=1))
+        self.assertRaises(milageread.NoReading, session.run)
+        self.assertEqual(self.sent('B903'), 1)
+
+    def test_ignition_on_cuts_wait_short(self):
+        # The voltage steps from 12.8V to 12.3V 0.5 seconds into a 10
+        # second wait; the COMBI is then given settle seconds.
+        self.emu.ignition_delay = 0.5
+        self.emu.started = time.time()
+        start = time.time()
+        session = self.session(retry=milageread.RetryPolicy(delay=10.0, poll=0.05, settle=0.2))
+        self.assertEqual(session.run(), (172450, 277531))
+        self.assertLess(time.time() - start, 2.0)
+        self.assertEqual(self.sent('B903'), 2)
+
+    def test_backoff_and_deadline(self):
+        policy = milageread.RetryPolicy(attempts=5, delay=1.0, backoff=2.0, max_delay=3.0)
+        self.assertEqual(list(policy.delays()), [1.0, 2.0, 3.0, 3.0])
+        self.emu.bus_init_errors = 10
+        session = self.session(retry=milageread.RetryPolicy(attempts=5, delay=0.2, poll=0.05,
+                                                            voltage_step=0, deadline=0.3))
+        self.assertRaises(milageread.NoReading, session.run)
+        # Retries start within 0.3 seconds of the first failure: two of them.
+        self.assertEqual(self.sent('B903'), 3)
+
+class BatchTest(EmulatorTest):
+    def setUp(self):
+        EmulatorTest.setUp(self)
+        self.emu.blocks = {(0x51, b'\xb9\x01'): bytearray(b'\xf9\x01\x12\x34'),
+                           (0x41, b'\xb9\xf0'): bytearray(b'\xf9\xf0\x56'),
+                           (0x41, b'\x1a\x80'): bytearray(b'\x5a\x80\x01\x02\x03')}
+
+    def batch(self, *specs):
+        session = self.session(requests=[milageread.parse_request(spec) for spec in specs])
+        self.assertEqual(session.run(), (172450, 277531))
+        return [(result['ecu'], result['request'], result['data'] or result['error']) for result in session.batch]
+
+    def test_grouped_by_ecu(self):
+        self.assertEqual(self.batch('41:B9F0', '51:B901', '41:1A80', '41:B9F1'),
+                         [('41', 'B9F0', '56'),
+                          ('51', 'B901', '12 34'),
+                          ('41', '1A80', '01 02 03'),
+                          ('41', 'B9F1', 'negative response 11')])
+        # The COMBI's group first, over the connection left open by B903,
+        # then one BUS INIT for all of ECU 41's requests.
+        between = self.emu.commands[self.emu.commands.index('B903'):self.emu.commands.index('B901')]
+        self.assertNotIn('ATPC', between)
+        self.assertEqual(self.sent('ATIIA 41'), 1)
+        self.assertEqual(self.sent('ATIIA 51'), 2)
+
+    def test_absent_ecu_tried_once(self):
+        self.assertEqual(self.batch('45:B901', '45:B902', '45:B9F0'),
+                         [('45', 'B901', 'BUS INIT: ...ERROR'),
+                          ('45', 'B902', 'BUS INIT: ...ERROR'),
+                          ('45', 'B9F0', 'BUS INIT: ...ERROR')])
+        # The first request and its one retry; nothing for the others.
+        self.assertEqual(self.sent('B901'), 2)
+        self.assertEqual(self.sent('B902') + self.sent('B9F0'), 0)
+
+class StoreTest(EmulatorTest):
+    def setUp(self):
+        EmulatorTest.setUp(self)
+        self.path = os.path.join(self.dir, 'readings.db')
+        self.store = milageread.ResultStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        EmulatorTest.tearDown(self)
+
+    def read(self, miles, vehicle):
+        self.emu.miles = miles
+        self.session(store=self.store, vehicle=vehicle).run()
+
+    def test_rollback_and_jump(self):
+        self.read(172450, 'CAR1')
+        self.read(172460, 'CAR1')
+        # Another car, and an unlabelled read, on the same port.
+        self.read(50000, 'CAR2')
+        self.read(1000, None)
+        self.read(172000, 'CAR1')
+        self.read(180000, 'CAR1')
+        self.assertEqual([(a['kind'], a['vehicle'], a['before']['miles'], a['after']['miles'])
+                          for a in self.store.anomalies()],
+                         [('rollback', 'CAR1', 172460, 172000),
+                          ('jump', 'CAR1', 172000, 180000)])
+        self.assertEqual([row['miles'] for row in self.store.history('CAR1')], [172450, 172460, 172000, 180000])
+        self.assertEqual(list(self.store.anomalies('CAR2')), [])
+
+    def test_lone_read_flushed_on_timer(self):
+        import sqlite3
+        self.store.flush_interval = 0.2
+        self.read(172450, 'CAR1')
+        time.sleep(0.5)
+        db = sqlite3.connect(self.path)
+        try:
+            self.assertEqual(db.execute('SELECT miles, vehicle FROM readings').fetchall(), [(172450, 'CAR1')])
+        finally:
+            db.close()
+
+if __name__ == '__main__':
+    unittest.main()